@@ -0,0 +1,463 @@
+"""Micro benchmarks for thorpy.
+
+Run all benchmarks with ``python benchmark.py`` or a selection with
+``python benchmark.py message_codec``.
+"""
+import struct
+import sys
+import timeit
+
+
+def _timeit(stmt, number):
+    """Return the throughput of stmt, in calls per second (best of 5)."""
+    return number / min(timeit.repeat(stmt, number = number, repeat = 5))
+
+
+def _legacy_bytes(msg):
+    """Reference encoder, as Message.__bytes__ was before the generated codecs."""
+    fields, msg_struct = msg.struct_description
+    descr = dict(msg.parameter_items)
+    descr['message_id'] = msg.id
+    descr['length'] = msg.binary_length - 6
+    descr['source'] = msg.source
+    descr['dest'] = msg.dest | (0x80 if msg.is_long_cmd else 0)
+    descr[None] = 0
+    values = map(lambda x: descr[x], fields)
+    type_mapping = {
+        str: lambda x: x.encode('ascii')
+    }
+    encoded_values = map(lambda x: type_mapping.get(type(x), type(x))(x), values)
+    return msg_struct.pack(*encoded_values)
+
+
+class _LegacyMessage:
+    """Reference message instance, built as by the Message constructor before __slots__ and the generated codecs.
+
+    The attributes live in the instance __dict__, and the name -> position mapping of the parameters
+    is rebuilt by every construction.
+    """
+    def __init__(self, msg_cls, *args, source = 0x01, dest = None, **kwargs):
+        self.msg_cls = msg_cls
+        self.dest, self.source = dest, source
+
+        parameter_values = [None, ] * len(msg_cls.parameters)
+        for i, value in enumerate(args):
+            parameter_values[i] = value
+        parameter_mapping = {name: position for position, (name, encoding) in enumerate(msg_cls.parameters)}
+        for name, value in kwargs.items():
+            position = parameter_mapping[name]
+            if parameter_values[position] is not None:
+                raise ValueError('Parameter {0} "{1}" was already set by positional argument.'.format(position, name))
+            parameter_values[position] = value
+        for position, ((name, encoding), value) in enumerate(zip(msg_cls.parameters, parameter_values)):
+            if name is not None and value is None:
+                raise ValueError('Parameter {0} "{1}" ({2}) was not set.'.format(position, name, encoding))
+        self._parameter_values = parameter_values
+
+    @property
+    def dest(self):
+        return self._dest
+
+    @dest.setter
+    def dest(self, destination_id):
+        if destination_id is not None:
+            assert isinstance(destination_id, int)
+            assert 0 <= destination_id <= 0x80
+        self._dest = destination_id
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, source_id):
+        if source_id is not None:
+            assert isinstance(source_id, int)
+            assert 0 <= source_id <= 0x80
+        self._source = source_id
+
+
+def _legacy_parse(buffer):
+    """Reference decoder, as Message.parse was before the registry and the generated codecs."""
+    from thorpy.message import Message
+    base_package = struct.Struct('<HHBB')
+    message_id, length, dest, source = base_package.unpack(buffer[:base_package.size])
+    long_message = (dest & 0x80) == 0x80
+    #Linear scan of all the message classes (the short and long variants of a command share their id)
+    message_classes = list(filter(lambda x: x.id == message_id and x.is_long_cmd == long_message, Message.__subclasses__()))
+    assert len(message_classes) < 2, 'Multiple classes with id {0} defined'.format(message_id)
+    if len(message_classes) < 1:
+        raise KeyError('Unknown message id {0}'.format(message_id))
+    msg_cls = message_classes[0]
+    fields, msg_struct = msg_cls.struct_description
+    descr = dict(zip(fields, msg_struct.unpack(buffer)))
+    if msg_cls.is_long_cmd:
+        assert descr['dest'] & 0x80, 'Long message expected, but message binary does not mark it as long.'
+        descr['dest'] &= 0x7f
+        assert descr['length'] == len(buffer) - 6
+        del descr['length']
+    assert descr['message_id'] == msg_cls.id
+    del descr['message_id']
+    if None in descr:
+        del descr[None]
+    return _LegacyMessage(msg_cls, **descr)
+
+
+def bench_message_codec(number = 100000):
+    from thorpy.message import MGMSG_MOT_GET_DCSTATUSUPDATE, MGMSG_MOT_MOVE_ABSOLUTE_long, Message
+
+    messages = [
+        MGMSG_MOT_GET_DCSTATUSUPDATE(chan_ident = 1, position = 123456, velocity = 12, status_bits = 0x80000400,
+                                     source = 0x50, dest = 0x01),
+        MGMSG_MOT_MOVE_ABSOLUTE_long(chan_ident = 1, absolute_distance = 123456, dest = 0x50),
+    ]
+    for msg in messages:
+        data = bytes(msg)
+        assert _legacy_bytes(msg) == data
+        assert bytes(Message.parse(data)) == data
+        legacy = _legacy_parse(data)
+        assert legacy.msg_cls is type(msg) and tuple(legacy._parameter_values) == msg._parameter_values
+
+        for operation, legacy, current in [
+                ('encode', lambda: _legacy_bytes(msg), lambda: bytes(msg)),
+                ('decode', lambda: _legacy_parse(data), lambda: Message.parse(data))]:
+            legacy_rate = _timeit(legacy, number)
+            current_rate = _timeit(current, number)
+            print('{0:<30} {1}: {2:>10.0f} msg/s (legacy {3:>9.0f} msg/s, {4:.1f}x)'.format(
+                msg.name, operation, current_rate, legacy_rate, current_rate / legacy_rate))
+
+
+def bench_templates(number = 100000):
+    """Encode frequently sent messages by constructing a Message or from a pre-encoded template."""
+    from thorpy.message import MGMSG_MOT_REQ_DCSTATUSUPDATE, MGMSG_MOT_MOVE_ABSOLUTE_long
+
+    req = MGMSG_MOT_REQ_DCSTATUSUPDATE.template(chan_ident = 1, dest = 0x50)
+    move = MGMSG_MOT_MOVE_ABSOLUTE_long.template('absolute_distance', chan_ident = 1, dest = 0x50)
+    for name, message, template in [
+            ('REQ_DCSTATUSUPDATE', lambda: bytes(MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = 1, dest = 0x50)), req.encode),
+            ('MOVE_ABSOLUTE_long', lambda: bytes(MGMSG_MOT_MOVE_ABSOLUTE_long(chan_ident = 1, absolute_distance = 1234, dest = 0x50)),
+             lambda: move.encode(1234))]:
+        message_rate = _timeit(message, number)
+        template_rate = _timeit(template, number)
+        print('{0:<20} template: {1:>9.0f} msg/s (message {2:>9.0f} msg/s, {3:.1f}x)'.format(
+            name, template_rate, message_rate, template_rate / message_rate))
+
+
+def bench_parse_many(count = 50000):
+    """Decode a capture of DCSTATUSUPDATE messages, one parse call per message or with a single parse_many call."""
+    import time
+    from thorpy.message import MGMSG_MOT_GET_DCSTATUSUPDATE, Message, IncompleteMessageException
+
+    msg = MGMSG_MOT_GET_DCSTATUSUPDATE(chan_ident = 1, position = 123456, velocity = 12, status_bits = 0x80000400,
+                                       source = 0x50, dest = 0x01)
+    data = bytes(msg) * count + bytes(msg)[:10]
+
+    def parse_loop():
+        offset, messages = 0, []
+        while True:
+            try:
+                msg = Message.parse(data, offset)
+            except IncompleteMessageException:
+                return messages
+            offset += len(msg)
+            messages.append(msg)
+
+    for name, f in [('parse', parse_loop), ('parse_many', lambda: Message.parse_many(data)[0])]:
+        start = time.perf_counter()
+        assert len(f()) == count
+        elapsed = time.perf_counter() - start
+        print('{0:<12} {1:>9.0f} msg/s, {2:>6.1f} MB/s'.format(name, count / elapsed, len(data) / elapsed / 1e6))
+
+
+def _pty_stream(data, chunk_size):
+    """Open a pseudo-terminal and write data to its master side from a thread.
+
+    Returns the slave side, opened with pyserial, and the writer thread."""
+    import os, pty, threading, tty, serial
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    port = serial.Serial(os.ttyname(slave), baudrate = 115200)
+    os.close(slave)
+
+    def write():
+        for i in range(0, len(data), chunk_size):
+            os.write(master, data[i:i + chunk_size])
+    writer = threading.Thread(target = write, daemon = True)
+    writer.start()
+    return master, port, writer
+
+
+def bench_receive(count = 20000):
+    """Receive DCSTATUSUPDATE messages through a pty, reading one byte or all available bytes per call."""
+    import os, select, time
+    from thorpy.comm.framer import Framer
+    from thorpy.message import MGMSG_MOT_GET_DCSTATUSUPDATE
+
+    msg = MGMSG_MOT_GET_DCSTATUSUPDATE(chan_ident = 1, position = 123456, velocity = 12, status_bits = 0x80000400,
+                                       source = 0x50, dest = 0x01)
+    data = bytes(msg) * count
+
+    for name, bulk in [('one byte per read', False), ('bulk reads', True)]:
+        master, port, writer = _pty_stream(data, 1024)
+        framer = Framer()
+        received = 0
+        start_cpu, start = time.thread_time(), time.perf_counter()
+        while received < count:
+            select.select([port], [], [], 1)
+            framer.feed(port.read(max(1, port.in_waiting) if bulk else 1))
+            received += len(framer.read_messages())
+        cpu, elapsed = time.thread_time() - start_cpu, time.perf_counter() - start
+        writer.join()
+        port.close()
+        os.close(master)
+        print('{0:<20} {1:>9.0f} msg/s, {2:>6.2f} us CPU/msg'.format(name, count / elapsed, cpu / count * 1e6))
+
+
+def bench_capture(count = 200000, duration = 2):
+    """Cost of recording with WireCapture: per call, and on the worker thread of a Port receiving a status stream."""
+    import os, tempfile, time
+    from thorpy.comm.capture import WireCapture
+    from thorpy.comm.port import Port
+    from thorpy.message import MGMSG_MOT_GET_DCSTATUSUPDATE, Message
+
+    data = bytes(MGMSG_MOT_GET_DCSTATUSUPDATE(chan_ident = 1, position = 123456, velocity = 12, status_bits = 0x80000400,
+                                              source = 0x50, dest = 0x01))
+    path = os.path.join(tempfile.mkdtemp(), 'capture.bin')
+    capture = WireCapture(path)
+    record_rate = _timeit(lambda: capture.record(WireCapture.RX, data), count)
+    capture.close()
+    parse_rate = _timeit(lambda: Message.parse(data), count)
+    records = sum(1 for record in WireCapture.read(path))
+    print('record: {0:>6.2f} us/call, parse: {1:>6.2f} us/frame, {2} records written, {3} dropped'.format(
+        1e6 / record_rate, 1e6 / parse_rate, records, capture.dropped))
+
+    controller, stops = _pty_controller(updates_per_ms = 10)
+    port = Port.create(controller.path, '83000001')
+    stages = port.get_stages()
+    cpu_clock = time.pthread_getcpuclockid(port._thread_worker.ident)
+    for name in ['without capture', 'with capture']:
+        if name == 'with capture':
+            capture = port.start_capture(path)
+        start_cpu = time.clock_gettime(cpu_clock)
+        received_count = []
+        counter = port.subscribe(MGMSG_MOT_GET_DCSTATUSUPDATE, callback = received_count.append)
+        time.sleep(duration)
+        port.unsubscribe(counter)
+        cpu = time.clock_gettime(cpu_clock) - start_cpu
+        print('port, {0:<16}: {1:>7.0f} msg/s, {2:>5.2f} us CPU/msg'.format(
+            name, len(received_count) / duration, cpu / len(received_count) * 1e6))
+    port.stop_capture()
+    print('capture: {0} records, {1} dropped'.format(sum(1 for record in WireCapture.read(path)), capture.dropped))
+    del stages, port
+    controller.close()
+    os.remove(path)
+
+
+def bench_replay(capture_path = None, duration = 1):
+    """Decode and handle captured traffic: each stage separately, then end to end through a Port and ReplayTransport.
+
+    Without capture_path, a session with the pty controller stand-in is captured first."""
+    import os, tempfile, time
+    from thorpy.comm.capture import WireCapture
+    from thorpy.comm.port import Port
+    from thorpy.comm.replay import ReplayTransport
+    from thorpy.message import MGMSG_MOT_GET_DCSTATUSUPDATE, Message
+
+    if capture_path is None:
+        capture_path = os.path.join(tempfile.mkdtemp(), 'session.cap')
+        controller, stops = _pty_controller(updates_per_ms = 10)
+        port = Port.create(controller.path, '83000001', capture = capture_path)
+        stages = port.get_stages()
+        time.sleep(duration)
+        port.stop_capture()
+        del stages, port
+        controller.close()
+
+    received = b''.join(data for timestamp, direction, data in WireCapture.read(capture_path) if direction == WireCapture.RX)
+    start = time.perf_counter()
+    messages, offset = Message.parse_many(received)
+    parse_rate = len(messages) / (time.perf_counter() - start)
+
+    transport = ReplayTransport(capture_path)
+    port = Port.create(transport, '83000001')
+    stage = port.get_stages()[1]
+    transport.finished.wait()
+    time.sleep(0.1)
+    for name, handle_message in [('SingleControllerPort._handle_message', port._handle_message),
+                                 ('GenericStage._handle_message', stage._handle_message)]:
+        start = time.perf_counter()
+        for msg in messages:
+            handle_message(msg)
+        print('{0:<36}: {1:>8.0f} msg/s'.format(name, len(messages) / (time.perf_counter() - start)))
+    print('{0:<36}: {1:>8.0f} msg/s'.format('Message.parse_many', parse_rate))
+    print('replay of {0} messages: {1} mismatches'.format(len(messages), len(transport.mismatches)))
+    del stage, port
+
+    #End to end, the pipe of the transport is filled as fast as the port reads it
+    transport = ReplayTransport(capture_path)
+    port = Port.create(transport, '83000001')
+    stage = port.get_stages()[1]
+    counted = []
+    port.subscribe(MGMSG_MOT_GET_DCSTATUSUPDATE, callback = counted.append)
+    cpu_clock = time.pthread_getcpuclockid(port._thread_worker.ident)
+    start, start_cpu = time.perf_counter(), time.clock_gettime(cpu_clock)
+    transport.finished.wait()
+    while transport.in_waiting or len(port._framer):
+        time.sleep(0.001)
+    elapsed, cpu = time.perf_counter() - start, time.clock_gettime(cpu_clock) - start_cpu
+    print('{0:<36}: {1:>8.0f} msg/s, {2:.2f} us CPU/msg (worker thread)'.format(
+        'Port with ReplayTransport', len(counted) / elapsed, cpu / max(len(counted), 1) * 1e6))
+    del stage, port
+
+
+def _pty_controller(serial_number = 83000001, updates_per_ms = 100):
+    """Emulated TDC001 controller with a MTS50-Z8 stage, flooding DCSTATUSUPDATE messages once update messages are started.
+
+    Returns the emulator and a list receiving (time, message) for every MOVE_STOP."""
+    import time
+    from thorpy.comm.emulator import ControllerEmulator
+    from thorpy.message import MGMSG_MOT_MOVE_STOP
+
+    stops = []
+    def on_message(msg):
+        if isinstance(msg, MGMSG_MOT_MOVE_STOP):
+            stops.append((time.perf_counter(), msg))
+    emulator = ControllerEmulator(serial_number = serial_number, status_rate = updates_per_ms * 1000, ack_limit = None,
+                                  on_message = on_message)
+    return emulator, stops
+
+
+def bench_send_latency(count = 200):
+    """Latency from send_message(MOVE_STOP) to the frame reaching the controller, under a heavy status stream."""
+    import statistics, time
+    from thorpy.comm.port import Port
+    from thorpy.message import MGMSG_MOT_MOVE_STOP
+
+    controller, stops = _pty_controller()
+    port = Port.create(controller.path, '83000001')
+    stages = port.get_stages()
+    blocked, latencies = [], []
+    for i in range(count):
+        start = time.perf_counter()
+        port.send_message(MGMSG_MOT_MOVE_STOP(chan_ident = 1, stop_mode = 2))
+        blocked.append(time.perf_counter() - start)
+        while len(stops) <= i:
+            time.sleep(0.0001)
+        latencies.append(stops[i][0] - start)
+        time.sleep(0.002)
+    del stages, port
+    controller.close()
+    for name, values in [('send_message call', blocked), ('until received', latencies)]:
+        values.sort()
+        print('{0:<18}: median {1:>5.0f} us, p99 {2:>5.0f} us, max {3:>5.0f} us'.format(
+            name, statistics.median(values) * 1e6, values[int(len(values) * 0.99)] * 1e6, values[-1] * 1e6))
+
+
+def bench_port_open(count = 5):
+    """Time to open a Port, up to the stages being available."""
+    import statistics, time
+    from thorpy.comm.port import Port
+
+    durations = []
+    for i in range(count):
+        controller, stops = _pty_controller(updates_per_ms = 0)
+        start = time.perf_counter()
+        port = Port.create(controller.path, '83000001')
+        stages = port.get_stages()
+        durations.append(time.perf_counter() - start)
+        del stages, port
+        controller.close()
+    print('Port.create: median {0:.3f} s, max {1:.3f} s'.format(statistics.median(durations), max(durations)))
+
+
+def bench_discovery(count = 8):
+    """Time to discover count controllers, one after the other or concurrently."""
+    import time
+    from thorpy.comm import discovery
+
+    #Only the emulated controllers, they are found without enumerating the USB devices
+    discovery._find_controller_ports = lambda serial_ports = None: []
+    for name, max_workers in [('sequential', 1), ('concurrent', None)]:
+        controllers = [_pty_controller(serial_number = 83000001 + i, updates_per_ms = 0) for i in range(count)]
+        start = time.perf_counter()
+        stages = list(discovery.discover_stages(max_workers = max_workers, report = None, cache = False,
+                                                emulators = [controller for controller, stops in controllers]))
+        elapsed = time.perf_counter() - start
+        assert len(stages) == count
+        del stages
+        for controller, stops in controllers:
+            controller.close()
+        print('{0:<10} {1} controllers: {2:.3f} s'.format(name, count, elapsed))
+
+
+def bench_reactor(counts = (1, 8, 32), duration = 2):
+    """Receive status streams from many controllers, with a worker thread per port or one shared reactor.
+
+    Reports the number of threads started for the ports (worker and writer threads, or the reactor thread)
+    and the CPU time of the receiving threads per received message."""
+    import threading, time
+    from thorpy.comm.port import Port
+    from thorpy.comm.reactor import Reactor
+    from thorpy.stages import GenericStage
+
+    received = [0]
+    handle_message = GenericStage._handle_message
+    def counting_handle_message(self, msg):
+        received[0] += 1
+        return handle_message(self, msg)
+    GenericStage._handle_message = counting_handle_message
+
+    def thread_cpu(thread):
+        return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+
+    try:
+        for count in counts:
+            for name, reactor in [('thread per port', None), ('shared reactor', Reactor())]:
+                controllers = [_pty_controller(serial_number = 83000001 + i, updates_per_ms = 1) for i in range(count)]
+                other_threads = set(threading.enumerate())
+                ports = [Port.create(controller.path, str(controller.serial_number), reactor) for controller, stops in controllers]
+                stages = [port.get_stages() for port in ports]
+                threads = [port._thread_worker for port in ports] if reactor is None else [reactor._thread]
+                port_threads = len(set(threading.enumerate()) - other_threads)
+                time.sleep(0.2)
+
+                start_received, start_cpu = received[0], sum(thread_cpu(t) for t in threads)
+                time.sleep(duration)
+                messages, cpu = received[0] - start_received, sum(thread_cpu(t) for t in threads) - start_cpu
+
+                del stages, ports
+                for controller, stops in controllers:
+                    controller.close()
+                if reactor is not None:
+                    reactor.close()
+                print('{0:>2} ports, {1:<15}: {2:>2} threads, {3:>7.0f} msg/s, {4:>5.1f} us CPU/msg'.format(
+                    count, name, port_threads, messages / duration, cpu / max(messages, 1) * 1e6))
+    finally:
+        GenericStage._handle_message = handle_message
+
+
+def bench_property_read(count = 50):
+    """Latency of reading GenericStage.position when the cached value is invalid."""
+    import statistics, time
+    from thorpy.comm.port import Port
+
+    controller, stops = _pty_controller(updates_per_ms = 0)
+    port = Port.create(controller.path, '83000001')
+    stage = port.get_stages()[1]
+    latencies = []
+    for i in range(count):
+        stage._state_position = None
+        start = time.perf_counter()
+        stage.position
+        latencies.append(time.perf_counter() - start)
+    del stage, port
+    controller.close()
+    print('position read: median {0:.2f} ms, max {1:.2f} ms'.format(
+        statistics.median(latencies) * 1e3, max(latencies) * 1e3))
+
+
+if __name__ == '__main__':
+    benchmarks = dict((name[len('bench_'):], f) for name, f in sorted(globals().items()) if name.startswith('bench_'))
+    for name in sys.argv[1:] or benchmarks:
+        print('== {0} =='.format(name))
+        benchmarks[name]()
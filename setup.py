@@ -15,4 +15,5 @@ setup(name="thorpy",
       install_requires=['pyserial>=2.7',
                         'pyusb>=1.0.0a'
                         ],
+      extras_require = {'numpy': ['numpy']},
       )
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from thorpy.comm.asyncport import AsyncPort
+from thorpy.comm.emulator import ControllerEmulator
+from thorpy.message import MGMSG_MOT_REQ_HOMEPARAMS
+from thorpy.stages import GenericStage
+
+
+class _NoHomeParamsEmulator(ControllerEmulator):
+    """Controller which never answers REQ_HOMEPARAMS"""
+    def handle(self, msg, now):
+        if isinstance(msg, MGMSG_MOT_REQ_HOMEPARAMS):
+            return []
+        return super().handle(msg, now)
+
+
+def _run(emulator_class, test):
+    async def main():
+        with emulator_class(serial_number = 83000101) as emulator:
+            port = await AsyncPort.create(emulator.path, '83000101')
+            try:
+                await test(port.get_stages()[1])
+            finally:
+                port.close()
+    asyncio.run(main())
+
+
+def test_awaitable_properties():
+    async def test(stage):
+        assert (await stage.status(max_age = 0)).position == 0
+        assert await stage.position == 0
+        assert await stage.status_homed in (True, False)
+        assert await stage.max_velocity == pytest.approx(stage.profile.apt_to_velocity(stage._state_max_velocity))
+        assert await stage.home_direction == stage._state_home_direction
+        assert await stage.move_to(0.5, timeout = 5)
+        assert await stage.read('position', max_age = 0) == pytest.approx(0.5, abs = 1e-4)
+    _run(ControllerEmulator, test)
+
+
+def test_timeout_raises():
+    async def test(stage):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        with pytest.raises(asyncio.TimeoutError):
+            await stage.read('home_velocity', timeout = 0.2)
+        with pytest.raises(asyncio.TimeoutError):
+            await stage.home_offset_distance
+        #The loop was never blocked by a synchronous wait
+        assert loop.time() - start < 3.5
+    _run(_NoHomeParamsEmulator, test)
+
+
+def test_synchronous_waits_are_refused():
+    async def test(stage):
+        with pytest.raises(TypeError):
+            GenericStage.read(stage, 'position')
+        with pytest.raises(AttributeError):
+            stage.max_velocity = 1.0
+        assert await stage.home_non_blocking()
+    _run(ControllerEmulator, test)
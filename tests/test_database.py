@@ -0,0 +1,33 @@
+import pytest
+
+from thorpy.stages.database import stage_database, stage_profile
+
+numpy = pytest.importorskip('numpy')
+
+
+def test_database_records():
+    record = stage_database()['MTS50-Z8']
+    assert record.enc_cnt == record.steps_per_rev * record.gearbox_ratio / record.pitch
+    assert stage_profile('MTS50-Z8') is stage_profile('MTS50-Z8')
+
+
+def test_scalar_positions_are_not_clipped():
+    profile = stage_profile('PRM1-Z8')
+    assert profile.position_to_counts(-10) == round(-10 * profile.position_factor)
+    assert profile.position_to_counts(-10, clip = True) == 0
+    assert profile.position_to_counts(0.7) == round(0.7 * profile.position_factor)
+
+
+@pytest.mark.parametrize('name', ['MTS50-Z8', 'PRM1-Z8'])
+def test_scalar_and_vector_conversions_agree(name):
+    profile = stage_profile(name)
+    positions = numpy.concatenate([numpy.linspace(profile.min_pos - 1, profile.max_pos + 1, 10001),
+                                   [0.7, profile.min_pos, profile.max_pos]])
+    counts = profile.positions_to_counts(positions)
+    assert counts.tolist() == [profile.position_to_counts(float(x), clip = True) for x in positions]
+    assert profile.positions_to_counts(positions, clip = False).tolist() == [profile.position_to_counts(float(x)) for x in positions]
+
+    velocities = numpy.linspace(0, 3, 1001)
+    assert profile.velocities_to_apt(velocities).tolist() == [profile.velocity_to_apt(float(x)) for x in velocities]
+    assert profile.accelerations_to_apt(velocities).tolist() == [profile.acceleration_to_apt(float(x)) for x in velocities]
+    assert numpy.allclose(profile.counts_to_positions(counts), [profile.counts_to_position(int(x)) for x in counts])
@@ -0,0 +1,38 @@
+import gc
+
+from thorpy.comm import discovery
+from thorpy.comm.discovery import DiscoveryCache
+from thorpy.comm.emulator import ControllerEmulator
+
+
+def test_cache_round_trip(tmp_path):
+    path = str(tmp_path / 'thorpy' / 'discovery.json')
+    cache = DiscoveryCache(path)
+    serial_ports = [('/dev/ttyUSB0', 'APT DC Motor Controller', {'SER': '83000001'})]
+    cache.update_ports(serial_ports, [('/dev/ttyUSB0', '83000001')])
+    cache.save()
+    assert DiscoveryCache(path)._controllers == {'83000001': {'port': '/dev/ttyUSB0'}}
+
+
+def test_cache_save_failure(tmp_path):
+    not_a_directory = tmp_path / 'file'
+    not_a_directory.write_text('')
+    cache = DiscoveryCache(str(not_a_directory / 'discovery.json'))
+    cache.update_ports([], [])
+    cache.save()
+
+
+def test_discover_emulated_controllers(monkeypatch):
+    #Only the emulated controllers, without enumerating the USB devices
+    monkeypatch.setattr(discovery, '_find_controller_ports', lambda serial_ports = None: [])
+    reports = []
+    with ControllerEmulator(serial_number = 83000301) as first, ControllerEmulator(serial_number = 83000302) as second:
+        stages = list(discovery.discover_stages(report = lambda *args: reports.append(args), cache = False,
+                                                emulators = [first, second]))
+        assert sorted(stage._port.serial_number for stage in stages) == [83000301, 83000302]
+        assert sorted(report[:2] for report in reports) == [(first.path, '83000301'), (second.path, '83000302')]
+        assert all(report[3] is None for report in reports)
+        del stages
+        gc.collect()
+    #Emulators are never found unless given
+    assert list(discovery.discover_stages(report = None, cache = False)) == []
@@ -0,0 +1,31 @@
+from thorpy.comm.emulator import ControllerModel
+from thorpy.message import (MGMSG_HW_START_UPDATEMSGS, MGMSG_MOT_MOVE_ABSOLUTE_long, MGMSG_MOT_MOVE_COMPLETED,
+                            MGMSG_MOT_MOVE_HOME, MGMSG_MOT_MOVE_HOMED)
+
+
+def _end_of_move(model):
+    now = model.next_event_time()
+    return now, model.end_of_move(now)
+
+
+def test_end_of_move_is_not_acknowledged():
+    model = ControllerModel(status_rate = 0, ack_limit = 2)
+    model.handle(MGMSG_HW_START_UPDATEMSGS(update_rate = 1), 0)
+    now = 0
+    for i in range(5):
+        model.handle(MGMSG_MOT_MOVE_ABSOLUTE_long(chan_ident = 1, absolute_distance = 1000 * (i + 1)), now)
+        now, msg = _end_of_move(model)
+        assert isinstance(msg, MGMSG_MOT_MOVE_COMPLETED)
+        assert msg['position'] == 1000 * (i + 1)
+    model.handle(MGMSG_MOT_MOVE_HOME(chan_ident = 1), now)
+    now, msg = _end_of_move(model)
+    assert isinstance(msg, MGMSG_MOT_MOVE_HOMED)
+    assert model.unacknowledged_updates == 0
+
+
+def test_status_updates_stop_without_ack():
+    model = ControllerModel(status_rate = 10, ack_limit = 50)
+    model.handle(MGMSG_HW_START_UPDATEMSGS(update_rate = 1), 0)
+    msg, count = model.status_updates(10)
+    assert count == 50
+    assert model.status_updates(20) == (None, 0)
@@ -0,0 +1,51 @@
+import struct
+
+from thorpy.comm.framer import Framer
+from thorpy.message import MGMSG_MOT_GET_DCSTATUSUPDATE, MGMSG_HW_REQ_INFO
+
+
+def _status(position):
+    return bytes(MGMSG_MOT_GET_DCSTATUSUPDATE(chan_ident=1, position=position, velocity=0, status_bits=0x400,
+                                              source=0x50, dest=0x01))
+
+
+def test_messages_split_across_feeds():
+    data = _status(1) + bytes(MGMSG_HW_REQ_INFO(dest=0x50)) + _status(2)
+    framer = Framer()
+    messages = []
+    for i in range(0, len(data), 5):
+        framer.feed(data[i:i + 5])
+        messages += framer.read_messages()
+    assert [type(msg) for msg in messages] == [MGMSG_MOT_GET_DCSTATUSUPDATE, MGMSG_HW_REQ_INFO,
+                                               MGMSG_MOT_GET_DCSTATUSUPDATE]
+    assert [messages[0]['position'], messages[2]['position']] == [1, 2]
+    assert len(framer) == 0
+
+
+def test_truncated_long_frame_is_skipped():
+    # Valid id and long destination, but a length field too small for a DCSTATUSUPDATE
+    truncated = struct.pack('<HHBB', MGMSG_MOT_GET_DCSTATUSUPDATE.id, 2, 0x81, 0x50) + b'\x01\x00'
+    framer = Framer()
+    framer.feed(truncated + _status(24013))
+    messages = framer.read_messages()
+    assert len(messages) == 1
+    assert messages[0]['position'] == 24013
+    assert framer.skipped_bytes == len(truncated)
+    assert len(framer) == 0
+
+
+def test_truncated_long_frame_at_end_of_buffer():
+    framer = Framer()
+    framer.feed(struct.pack('<HHBB', MGMSG_MOT_GET_DCSTATUSUPDATE.id, 2, 0x81, 0x50) + b'\x01\x00')
+    assert framer.read_messages() == []
+    framer.feed(_status(5))
+    assert [msg['position'] for msg in framer.read_messages()] == [5]
+
+
+def test_unknown_frame_is_skipped():
+    unknown = struct.pack('<HHBB', 0x7ff0, 4, 0x81, 0x50) + b'\x00' * 4
+    framer = Framer()
+    framer.feed(unknown + _status(3))
+    assert [msg['position'] for msg in framer.read_messages()] == [3]
+    assert framer.skipped_frames == 1
+    assert framer.skipped_bytes == len(unknown)
@@ -0,0 +1,114 @@
+import sys
+import threading
+
+import pytest
+
+from thorpy.message import Message, MGMSG_MOT_GET_DCSTATUSUPDATE, MGMSG_MOT_MOVE_ABSOLUTE_long, MGMSG_MOT_MOVE_HOMED
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Restore the message class registry after the test"""
+    monkeypatch.setattr(Message, '_message_classes', dict(Message._message_classes))
+    monkeypatch.setattr(Message, '_message_classes_by_name', dict(Message._message_classes_by_name))
+
+
+def test_round_trip():
+    msg = MGMSG_MOT_GET_DCSTATUSUPDATE(chan_ident=1, position=-1234, velocity=12, status_bits=0x400,
+                                       source=0x50, dest=0x01)
+    parsed = Message.parse(bytes(msg))
+    assert type(parsed) is MGMSG_MOT_GET_DCSTATUSUPDATE
+    assert list(parsed.parameter_items) == list(msg.parameter_items)
+    assert (parsed.dest, parsed.source) == (0x01, 0x50)
+
+    parsed = Message.parse(bytes(MGMSG_MOT_MOVE_HOMED(chan_ident=1, source=0x50, dest=0x01)))
+    assert type(parsed) is MGMSG_MOT_MOVE_HOMED and parsed['chan_ident'] == 1
+
+
+def test_length_mismatch():
+    data = bytearray(bytes(MGMSG_MOT_GET_DCSTATUSUPDATE(chan_ident=1, position=0, velocity=0, status_bits=0,
+                                                        source=0x50, dest=0x01)))
+    data[2] += 1
+    data.append(0)
+    with pytest.raises(ValueError):
+        Message.parse(data)
+    with pytest.raises(ValueError):
+        MGMSG_MOT_GET_DCSTATUSUPDATE._decode(data)
+    with pytest.raises(ValueError):
+        Message.parse_many(data)
+
+
+def test_iter_parse_skips_bad_frames():
+    status = bytes(MGMSG_MOT_GET_DCSTATUSUPDATE(chan_ident=1, position=5, velocity=0, status_bits=0,
+                                                source=0x50, dest=0x01))
+    homed = bytes(MGMSG_MOT_MOVE_HOMED(chan_ident=1, source=0x50, dest=0x01))
+    unknown = b'\x77\x77\x01\x00\x01\x50'
+    stream = status + unknown + b'\xff\xff' + homed + homed[:3]
+    chunks = [stream[i:i + 5] for i in range(0, len(stream), 5)]
+
+    with pytest.raises(KeyError):
+        list(Message.iter_parse(chunks))
+
+    skipped = []
+    messages = list(Message.iter_parse(chunks, on_skip=lambda *args: skipped.append(args)))
+    assert [type(msg) for msg in messages] == [MGMSG_MOT_GET_DCSTATUSUPDATE, MGMSG_MOT_MOVE_HOMED]
+    assert skipped == [(len(status), 6, True), (len(status) + 6, 2, False)]
+
+
+def test_duplicate_id(registry):
+    with pytest.raises(ValueError):
+        class MGMSG_TEST_DUPLICATE(Message):
+            id = MGMSG_MOT_MOVE_HOMED.id
+            parameters = [('chan_ident', 'B'), (None, 'B')]
+    assert Message._message_classes[(MGMSG_MOT_MOVE_HOMED.id, False)] is MGMSG_MOT_MOVE_HOMED
+    assert 'MGMSG_TEST_DUPLICATE' not in Message._message_classes_by_name
+
+    #The same id is allowed for a short and a long message
+    class MGMSG_TEST_DUPLICATE_long(Message):
+        id = MGMSG_MOT_MOVE_HOMED.id
+        is_long_cmd = True
+        parameters = [('chan_ident', 'H')]
+    assert Message._message_classes[(MGMSG_MOT_MOVE_HOMED.id, True)] is MGMSG_TEST_DUPLICATE_long
+
+
+def test_subclass_replaces_parent(registry):
+    class MGMSG_TEST_MOVE_HOMED(MGMSG_MOT_MOVE_HOMED):
+        pass
+    data = bytes(MGMSG_MOT_MOVE_HOMED(chan_ident=2, source=0x50, dest=0x01))
+    parsed = Message.parse(data)
+    assert type(parsed) is MGMSG_TEST_MOVE_HOMED and parsed['chan_ident'] == 2
+    assert bytes(parsed) == data
+
+
+def test_template_encode():
+    template = MGMSG_MOT_MOVE_ABSOLUTE_long.template('absolute_distance', dest=0x50, chan_ident=1)
+    assert MGMSG_MOT_MOVE_ABSOLUTE_long.template('absolute_distance', dest=0x50, chan_ident=1) is template
+    for distance in (0, 1234, -34304, 2 ** 31 - 1):
+        assert template.encode(distance) == bytes(MGMSG_MOT_MOVE_ABSOLUTE_long(chan_ident=1, absolute_distance=distance,
+                                                                               dest=0x50))
+    fixed = MGMSG_MOT_MOVE_HOMED.template(dest=0x50, chan_ident=1)
+    assert fixed.encode() == bytes(MGMSG_MOT_MOVE_HOMED(chan_ident=1, dest=0x50))
+
+
+def test_template_encode_threads():
+    template = MGMSG_MOT_MOVE_ABSOLUTE_long.template('absolute_distance', dest=0x50, chan_ident=1)
+    errors = []
+
+    def encode(first):
+        for distance in range(first, first + 2000):
+            msg = Message.parse(template.encode(distance))
+            if msg['absolute_distance'] != distance or msg['chan_ident'] != 1:
+                errors.append((distance, msg))
+
+    threads = [threading.Thread(target=encode, args=(i * 100000, )) for i in range(8)]
+    #Switch threads as often as possible, so that unprotected encodings would interleave
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
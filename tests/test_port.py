@@ -0,0 +1,80 @@
+import errno
+import gc
+import time
+
+import pytest
+import serial
+
+from thorpy.comm.emulator import ControllerEmulator
+from thorpy.comm.port import Port
+from thorpy.comm.replay import ReplayTransport
+from thorpy.message import MGMSG_MOT_MOVE_HOME, MGMSG_MOT_REQ_VELPARAMS
+
+
+def _failing_write(data):
+    raise serial.SerialException(errno.EIO, 'Input/output error')
+
+
+def test_request():
+    with ControllerEmulator(serial_number = 83000201) as emulator:
+        port = Port.create(emulator.path, '83000201')
+        response = port.request(MGMSG_MOT_REQ_VELPARAMS(chan_ident = 1), timeout = 3)
+        assert response['max_velocity'] == emulator.max_velocity
+        del port, response
+        gc.collect()
+
+
+
+def test_invalid_requests():
+    with ControllerEmulator(serial_number = 83000205) as emulator:
+        port = Port.create(emulator.path, '83000205')
+        with pytest.raises(ValueError):
+            port.request(MGMSG_MOT_MOVE_HOME(chan_ident = 1), timeout = 1)
+        with pytest.raises(ValueError):
+            port.request(port.template(MGMSG_MOT_REQ_VELPARAMS, 'chan_ident'), timeout = 1, values = (1, ))
+        assert port.request(port.template(MGMSG_MOT_REQ_VELPARAMS, chan_ident = 1), timeout = 3) is not None
+        del port
+        gc.collect()
+
+def test_write_failure():
+    with ControllerEmulator(serial_number = 83000202) as emulator:
+        port = Port.create(emulator.path, '83000202')
+        port._serial.write = _failing_write
+        start = time.time()
+        with pytest.raises(serial.SerialException):
+            port.request(MGMSG_MOT_REQ_VELPARAMS(chan_ident = 1), timeout = 3)
+        #The pending request failed as soon as the write failed
+        assert time.time() - start < 1
+        with pytest.raises(serial.SerialException):
+            port.send_message(MGMSG_MOT_REQ_VELPARAMS(chan_ident = 1))
+        with pytest.raises(serial.SerialException):
+            port.request(MGMSG_MOT_REQ_VELPARAMS(chan_ident = 1), timeout = 3)
+        #The exceptions hold references to the port, it must be closed before the emulator
+        del port
+        gc.collect()
+
+
+def test_port_locks_only_by_name():
+    with ControllerEmulator(serial_number = 83000203) as emulator:
+        port = Port.create(emulator.path, '83000203')
+        assert Port.create(emulator.path, '83000203') is port
+        assert all(isinstance(key, str) for key in Port.static_port_locks)
+        assert emulator.path in Port.static_port_locks
+        del port
+        gc.collect()
+
+
+def test_replayed_port_is_not_locked_by_transport(tmp_path):
+    capture = str(tmp_path / 'capture.bin')
+    with ControllerEmulator(serial_number = 83000204) as emulator:
+        port = Port.create(emulator.path, '83000204', capture = capture)
+        port.request(MGMSG_MOT_REQ_VELPARAMS(chan_ident = 1), timeout = 3)
+        port.stop_capture()
+        del port
+        gc.collect()
+
+    transport = ReplayTransport(capture)
+    port = Port.create(transport, '83000204')
+    assert port.request(MGMSG_MOT_REQ_VELPARAMS(chan_ident = 1), timeout = 3) is not None
+    assert transport not in Port.static_port_locks
+    del port
@@ -0,0 +1,61 @@
+import errno
+import gc
+import threading
+
+import pytest
+import serial
+
+from thorpy.comm.emulator import ControllerEmulator
+from thorpy.comm.port import Port
+from thorpy.comm.reactor import Reactor
+from thorpy.message import MGMSG_MOT_REQ_VELPARAMS
+
+
+def test_single_thread_for_all_ports():
+    reactor = Reactor()
+    emulators = [ControllerEmulator(serial_number = 83000401 + i) for i in range(4)]
+    try:
+        other_threads = set(threading.enumerate())
+        ports = [Port.create(emulator.path, str(emulator.serial_number), reactor) for emulator in emulators]
+        assert set(threading.enumerate()) - other_threads == {reactor._thread}
+        for port, emulator in zip(ports, emulators):
+            response = port.request(MGMSG_MOT_REQ_VELPARAMS(chan_ident = 1), timeout = 3)
+            assert response['max_velocity'] == emulator.max_velocity
+        stages = [port.get_stages()[1] for port in ports]
+        assert [stage.status(max_age = 0).position for stage in stages] == [0] * 4
+        del ports, stages, port, response
+        gc.collect()
+    finally:
+        for emulator in emulators:
+            emulator.close()
+        reactor.close()
+
+
+def test_reactor_closed_before_port():
+    reactor = Reactor()
+    with ControllerEmulator(serial_number = 83000411) as emulator:
+        port = Port.create(emulator.path, '83000411', reactor)
+        serial_port = port._serial
+        reactor.close()
+        reactor.unregister(serial_port.fileno())
+        del port
+        gc.collect()
+        assert not serial_port.is_open
+
+
+def test_write_failure_raises_in_caller():
+    reactor = Reactor()
+    with ControllerEmulator(serial_number = 83000421) as emulator:
+        port = Port.create(emulator.path, '83000421', reactor)
+        port._serial.write = _failing_write
+        with pytest.raises(serial.SerialException):
+            port.send_message(MGMSG_MOT_REQ_VELPARAMS(chan_ident = 1))
+        with pytest.raises(serial.SerialException):
+            port.request(MGMSG_MOT_REQ_VELPARAMS(chan_ident = 1), timeout = 3)
+        del port
+        gc.collect()
+    reactor.close()
+
+
+def _failing_write(data):
+    raise serial.SerialException(errno.EIO, 'Input/output error')
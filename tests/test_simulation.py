@@ -0,0 +1,76 @@
+import math
+
+import pytest
+
+from thorpy.comm.simulation import SimulatedPort, VirtualClock
+from thorpy.message import MGMSG_MOT_MOVE_HOME, MGMSG_MOT_REQ_HOMEPARAMS
+
+
+def _stage(**kwargs):
+    port = SimulatedPort(**kwargs)
+    return port, port.get_stages()[1]
+
+
+def test_move_duration():
+    port, stage = _stage()
+    start = port.clock.time()
+    stage.position = 10.0
+    assert port.clock.advance() is False
+    #Trapezoidal profile at 2.8 mm/s and 1.5 mm/s²
+    assert port.clock.time() - start == pytest.approx(10 / 2.8 + 2.8 / 1.5, rel = 1e-3)
+    assert stage.status(max_age = 0).position == pytest.approx(10.0)
+    assert not stage.status().in_motion
+
+
+def test_home():
+    port, stage = _stage(position = 5 * 34304)
+    start = port.clock.time()
+    assert stage.home()
+    assert stage.status_homed
+    assert stage.status(max_age = 0).position == 0
+    #Back 6 mm at 1 mm/s (the limit switch is 1 mm before the home position), then 1 mm at 2.8 mm/s,
+    #with the polling of home() every second
+    duration = (6 + 1 / 1.5) + 2 * math.sqrt(1 / 1.5)
+    assert duration <= port.clock.time() - start <= math.ceil(duration)
+
+
+def test_status_updates_acknowledged_during_long_sleeps():
+    port, stage = _stage(status_rate = 10, ack_limit = 50)
+    stage.status()
+    port.clock.sleep(1000)
+    assert port.clock.time() == 1000
+    #Without the ACKs of the stage, the updates would have stopped after 5 s
+    assert stage.age('position') <= 0.1
+    assert port.model.unacknowledged_updates < 50
+
+
+def test_shared_clock():
+    clock = VirtualClock()
+    ports = [SimulatedPort(clock = clock, serial_number = 83000501 + i) for i in range(2)]
+    stages = [port.get_stages()[1] for port in ports]
+    stages[0].position = 1.0
+    stages[1].position = 2.0
+    clock.advance()
+    #Triangular profile, 2 mm is too short to reach 2.8 mm/s
+    assert clock.time() == pytest.approx(2 * math.sqrt(2 / 1.5), rel = 2e-3)
+    assert [stage.status(max_age = 0).position for stage in stages] == [pytest.approx(1.0), pytest.approx(2.0)]
+
+
+def test_request_without_answer():
+    port, stage = _stage()
+    port.model.handle = lambda msg, now: []
+    #With a timeout, the clock advances to it
+    assert port.request(MGMSG_MOT_REQ_HOMEPARAMS(chan_ident = 1), timeout = 2) is None
+    assert port.clock.time() == 2
+    #Without timeout, no answer can ever arrive
+    with pytest.raises(RuntimeError):
+        port.request(MGMSG_MOT_REQ_HOMEPARAMS(chan_ident = 1))
+
+
+def test_invalid_requests():
+    port = SimulatedPort()
+    with pytest.raises(ValueError):
+        port.request(MGMSG_MOT_MOVE_HOME(chan_ident = 1))
+    with pytest.raises(ValueError):
+        port.request(port.template(MGMSG_MOT_REQ_HOMEPARAMS, 'chan_ident'), values = (1, ))
+    assert port.request(port.template(MGMSG_MOT_REQ_HOMEPARAMS, chan_ident = 1), timeout = 1) is not None
@@ -0,0 +1,92 @@
+import pytest
+
+from thorpy.comm.emulator import ControllerModel
+from thorpy.comm.simulation import SimulatedPort
+from thorpy.message import MGMSG_MOT_MOVE_ABSOLUTE_long, MGMSG_MOT_REQ_VELPARAMS
+from thorpy.stages import GenericStage
+
+
+def _stage(**kwargs):
+    port = SimulatedPort(**kwargs)
+    return port, port.get_stages()[1]
+
+
+def test_property_values():
+    port, stage = _stage(position = 34304)
+    for name in GenericStage._property_states:
+        assert stage.read(name) == getattr(stage, name), name
+    assert stage.position == pytest.approx(1.0)
+    assert stage.status_channel_enabled is True
+    assert stage.home_offset_distance == pytest.approx(1.0)
+    assert stage.max_velocity == pytest.approx(stage.profile.apt_to_velocity(port.model.max_velocity))
+
+
+class _SilentModel(ControllerModel):
+    """Controller which stops answering the requests once silent is set"""
+    silent = False
+
+    def handle(self, msg, now):
+        responses = super().handle(msg, now)
+        return [] if self.silent else responses
+
+
+def test_read_max_age():
+    requests = []
+    port, stage = _stage(status_rate = 0, on_message = lambda msg: requests.append(msg) if isinstance(msg, MGMSG_MOT_REQ_VELPARAMS) else None)
+    assert stage.age('max_velocity') is None
+    stage.read('max_velocity')
+    assert stage.age('max_velocity') == 0
+    count = len(requests)
+
+    port.clock.sleep(10)
+    assert stage.age('max_velocity') == 10
+    #Young enough, or no max_age: the cached value
+    stage.read('max_velocity', max_age = 20)
+    stage.read('max_velocity')
+    assert len(requests) == count
+    #Too old: requested again
+    stage.read('max_velocity', max_age = 5)
+    assert len(requests) == count + 1
+    assert stage.age('max_velocity') == 0
+    assert stage.age('min_velocity') == 0
+    #A value received at the same (virtual) time has age 0
+    stage.read('max_velocity', max_age = 0)
+    assert len(requests) == count + 1
+    port.clock.sleep(0.001)
+    stage.read('max_velocity', max_age = 0)
+    assert len(requests) == count + 2
+
+
+def test_status_max_age():
+    port, stage = _stage(status_rate = 0, position = 34304)
+    status = stage.status()
+    assert status.position == pytest.approx(1.0)
+    assert status.timestamp == port.clock.time()
+    port.clock.sleep(1)
+    assert stage.status(max_age = 2) == status
+    assert stage.age('position') == 1
+    assert stage.status(max_age = 0.5).timestamp == port.clock.time()
+
+
+def test_stale_values_time_out():
+    port, stage = _stage(model = _SilentModel(status_rate = 0))
+    stage.read('max_velocity')
+    stage.status()
+    port.model.silent = True
+    port.clock.sleep(100)
+
+    with pytest.raises(TimeoutError):
+        stage.read('max_velocity', max_age = 0.05)
+    with pytest.raises(TimeoutError):
+        stage.status(max_age = 0.05)
+    #Without max_age, the cached values are still returned
+    assert stage.read('max_velocity') == stage.max_velocity
+    assert stage.status().timestamp == 0
+    assert stage.age('max_velocity') == pytest.approx(106)
+
+
+def test_move_outside_of_range_is_not_clipped():
+    moves = []
+    port, stage = _stage(on_message = lambda msg: moves.append(msg) if isinstance(msg, MGMSG_MOT_MOVE_ABSOLUTE_long) else None)
+    stage.position = -0.5
+    assert [msg['absolute_distance'] for msg in moves] == [-17152]
@@ -0,0 +1,90 @@
+import gc
+import threading
+import time
+
+import pytest
+
+from thorpy.comm.emulator import ControllerEmulator
+from thorpy.comm.port import Port
+from thorpy.comm.subscription import Subscription
+from thorpy.message import (MGMSG_HW_START_UPDATEMSGS, MGMSG_HW_STOP_UPDATEMSGS, MGMSG_MOT_GET_DCSTATUSUPDATE,
+                            MGMSG_MOT_MOVE_ABSOLUTE_long, MGMSG_MOT_MOVE_HOMED, MGMSG_MOT_REQ_VELPARAMS)
+
+
+@pytest.fixture
+def port():
+    #1000 status updates per second, which never stop for lack of ACK
+    with ControllerEmulator(serial_number = 83000601, status_rate = 1000, ack_limit = None) as emulator:
+        port = Port.create(emulator.path, '83000601')
+        yield port
+        del port
+        gc.collect()
+
+
+def _stop_updates(port):
+    port.send_message(MGMSG_HW_STOP_UPDATEMSGS())
+    time.sleep(0.1)
+
+
+def test_drop_policies(port):
+    received = []
+    everything = port.subscribe(MGMSG_MOT_GET_DCSTATUSUPDATE, callback = received.append)
+    oldest = port.subscribe(MGMSG_MOT_GET_DCSTATUSUPDATE, chan_ident = 1, maxsize = 5, overflow = Subscription.DROP_OLDEST)
+    newest = port.subscribe(MGMSG_MOT_GET_DCSTATUSUPDATE, maxsize = 5, overflow = Subscription.DROP_NEWEST)
+    other_channel = port.subscribe(MGMSG_MOT_GET_DCSTATUSUPDATE, chan_ident = 2)
+    port.send_message(MGMSG_MOT_MOVE_ABSOLUTE_long(chan_ident = 1, absolute_distance = 34304))
+    time.sleep(0.3)
+    _stop_updates(port)
+
+    assert len(received) > 100
+    assert len(oldest) == len(newest) == 5
+    assert oldest.dropped == newest.dropped == len(received) - 5
+    assert len(other_channel) == 0 and other_channel.dropped == 0
+    #drop_newest keeps the first messages, drop_oldest the last ones
+    assert [newest.get(0) for i in range(5)] == received[:5]
+    assert [oldest.get(0) for i in range(5)] == received[-5:]
+    assert oldest.get(0) is None
+    for subscription in (everything, oldest, newest, other_channel):
+        port.unsubscribe(subscription)
+
+
+def test_block_stalls_the_port(port):
+    blocking = port.subscribe(MGMSG_MOT_GET_DCSTATUSUPDATE, maxsize = 2, overflow = Subscription.BLOCK)
+    time.sleep(0.1)
+    assert len(blocking) == 2 and blocking.dropped == 0
+    #The worker thread waits for room in the queue, the response is not received
+    assert port.request(MGMSG_MOT_REQ_VELPARAMS(chan_ident = 1), timeout = 0.3) is None
+    #Unsubscribing wakes it up
+    port.unsubscribe(blocking)
+    assert port.request(MGMSG_MOT_REQ_VELPARAMS(chan_ident = 1), timeout = 3) is not None
+
+
+def test_unsubscribe_wakes_readers(port):
+    subscription = port.subscribe(MGMSG_MOT_MOVE_HOMED)
+    results = []
+    reader = threading.Thread(target = lambda: results.append(subscription.get()))
+    reader.start()
+    time.sleep(0.1)
+    assert reader.is_alive()
+    port.unsubscribe(subscription)
+    reader.join(1)
+    assert not reader.is_alive()
+    assert results == [None]
+
+
+def test_unhandled_messages_are_bounded(monkeypatch):
+    monkeypatch.setattr(Port, 'unhandled_messages_maxsize', 10)
+    with ControllerEmulator(serial_number = 83000602, status_rate = 1000, ack_limit = None) as emulator:
+        #Without stages, the status updates are not handled
+        port = Port.create(emulator.path, '83000602')
+        time.sleep(0.2)
+        _stop_updates(port)
+        assert port.dropped_unhandled_messages > 0
+        messages = [port.recv_message(timeout = 0) for i in range(11)]
+        assert all(isinstance(msg, MGMSG_MOT_GET_DCSTATUSUPDATE) for msg in messages[:10])
+        assert messages[10] is None
+        #Reading makes room again
+        port.send_message(MGMSG_HW_START_UPDATEMSGS(update_rate = 1))
+        assert isinstance(port.recv_message(timeout = 1), MGMSG_MOT_GET_DCSTATUSUPDATE)
+        del port
+        gc.collect()
@@ -0,0 +1,207 @@
+import asyncio
+import weakref
+
+from .framer import Framer
+from .port import Port
+
+class AsyncPort:
+    """Port of a single controller, driven by an asyncio event loop instead of threads.
+
+    The serial port is registered with :meth:`asyncio.AbstractEventLoop.add_reader`, received messages
+    are handled in the event loop, so that a single loop can drive many controllers.
+    Messages are written directly to the serial port, which does not block for messages this small.
+
+    Create instances with ``await AsyncPort.create(port, sn)``.
+    """
+    clock = Port.clock
+
+    def __init__(self, port, sn, loop = None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._port = port
+        self._serial_number = int(sn)
+        self._debug = False
+        self._framer = Framer()
+        #Pending requests: (response class, chan_ident) -> list of futures
+        self._requests = {}
+        self._unhandled_messages = asyncio.Queue(Port.unhandled_messages_maxsize)
+        self._stages = weakref.WeakValueDictionary()
+        self._info_message = None
+        self._serial = Port._open_serial(port)
+        self._serial.timeout = 0
+
+    @classmethod
+    async def create(cls, port, sn):
+        self = cls(port, sn, asyncio.get_running_loop())
+        await self._initialize()
+        return self
+
+    async def _initialize(self):
+        from ..message import MGMSG_HW_NO_FLASH_PROGRAMMING, MGMSG_HW_REQ_INFO, MGMSG_HW_START_UPDATEMSGS, MGMSG_HW_STOP_UPDATEMSGS
+
+        #See Port.__init__ for the reasons of this sequence
+        rts_start_time = self._loop.time()
+        has_rts = Port._set_rts(self._serial, 1)
+        self._serial.reset_input_buffer()
+        self._serial.reset_output_buffer()
+        if has_rts:
+            await asyncio.sleep(max(0, Port.handshake_rts_pulse - (self._loop.time() - rts_start_time)))
+        Port._set_rts(self._serial, 0)
+
+        self.send_message(MGMSG_HW_NO_FLASH_PROGRAMMING())
+        self.send_message(MGMSG_HW_STOP_UPDATEMSGS())
+        await self._drain_input()
+
+        self._loop.add_reader(self._serial.fileno(), self._on_readable)
+        for attempt in range(Port.handshake_info_retries):
+            self._info_message = await self.request(MGMSG_HW_REQ_INFO(), timeout = Port.handshake_info_timeout)
+            if self._info_message is not None:
+                break
+        else:
+            self.close()
+            raise TimeoutError("No answer to HW_REQ_INFO on {0} after {1} attempts".format(self._port, Port.handshake_info_retries))
+
+        self.send_message(MGMSG_HW_START_UPDATEMSGS(update_rate = 1))
+
+        if self.channel_count != 1:
+            self.close()
+            raise NotImplementedError("Multiple channel devices are not supported yet")
+        print("Constructed: {0!r}".format(self))
+
+    async def _drain_input(self):
+        """Discard the received bytes until the input has been quiet, see :meth:`Port._drain_input`"""
+        start_time = self._loop.time()
+        while self._loop.time() - start_time < Port.handshake_drain_timeout:
+            await asyncio.sleep(Port.handshake_quiet_time)
+            if not self._serial.in_waiting:
+                break
+            self._serial.reset_input_buffer()
+
+    def close(self):
+        if self._serial.is_open:
+            self._loop.remove_reader(self._serial.fileno())
+            self._serial.close()
+
+    def fileno(self):
+        return self._serial.fileno()
+
+    def send_message(self, msg):
+        msg.source = 0x01
+        msg.dest = 0x50
+        self.send_bytes(bytes(msg))
+
+    def send_bytes(self, data):
+        """Send an already encoded message, e.g. from a :class:`~thorpy.message.MessageTemplate`"""
+        if self._debug:
+            from ..message import Message
+            print('> ', Message.parse(data))
+        self._serial.write(data)
+
+    def template(self, msg_cls, *varying, **fixed):
+        """Return a pre-encoded message addressed to this controller, see :meth:`thorpy.message.Message.template`"""
+        return msg_cls.template(*varying, source = 0x01, dest = 0x50, **fixed)
+
+    async def request(self, msg, timeout = None, response_classes = None, values = ()):
+        """Send a REQ message and wait for the matching GET message, see :meth:`Port.request`"""
+        from ..message import MessageTemplate
+        response_classes, parameters = Port._request_parameters(msg, response_classes)
+        keys = [(cls, parameters['chan_ident'] if 'chan_ident' in cls.parameter_names else None)
+                for cls in response_classes]
+
+        future = self._loop.create_future()
+        for key in keys:
+            self._requests.setdefault(key, []).append(future)
+
+        if isinstance(msg, MessageTemplate):
+            self.send_bytes(msg.encode(*values))
+        else:
+            self.send_message(msg)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            for key in keys:
+                futures = self._requests.get(key, [])
+                if future in futures:
+                    futures.remove(future)
+                if not futures:
+                    self._requests.pop(key, None)
+
+    async def recv_message(self, timeout = None):
+        try:
+            return await asyncio.wait_for(self._unhandled_messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def _on_readable(self):
+        self._framer.feed(self._serial.read(max(1, self._serial.in_waiting)))
+        for msg in self._framer.read_messages():
+            if self._debug:
+                print('< ', msg)
+            message_handled = self._handle_message(msg)
+            if self._requests:
+                message_handled = self._resolve_requests(msg) or message_handled
+            if not message_handled:
+                if self._debug:
+                    print("Unhandled message", msg)
+                #Keep the newest messages, see Port.recv_message
+                if self._unhandled_messages.full():
+                    self._unhandled_messages.get_nowait()
+                self._unhandled_messages.put_nowait(msg)
+
+    def _resolve_requests(self, msg):
+        key = (type(msg), msg['chan_ident'] if 'chan_ident' in msg else None)
+        futures = self._requests.pop(key, None)
+        if not futures:
+            return False
+        for future in futures:
+            if not future.done():
+                future.set_result(msg)
+        return True
+
+    def _handle_message(self, msg):
+        #Is it a channel message? In that case the stage object has to handle it
+        if 'chan_ident' in msg:
+            try:
+                return self._stages[msg['chan_ident']]._handle_message(msg)
+            except KeyError:
+                #Keep messages to stages that don't exist
+                return False
+        return False
+
+    @property
+    def serial_number(self):
+        return self._serial_number
+
+    @property
+    def channel_count(self):
+        return self._info_message['nchs']
+
+    @property
+    def skipped_frames(self):
+        return self._framer.skipped_frames
+
+    @property
+    def skipped_bytes(self):
+        return self._framer.skipped_bytes
+
+    def __repr__(self):
+        return '{0}({1!r},{2!r})'.format(self.__class__.__name__, self._port, self._serial_number)
+
+    def get_stages(self, only_chan_idents = None):
+        from thorpy.stages import stage_name_from_get_hw_info
+        from thorpy.stages.asyncstage import AsyncStage
+        if only_chan_idents is None:
+            only_chan_idents = [0x01]
+
+        assert len(only_chan_idents) <= 1
+        assert all(x == 1 for x in only_chan_idents)
+
+        ret = dict([(k, self._stages.get(k, None)) for k in only_chan_idents])
+        for k in only_chan_idents:
+            if ret[k] is None:
+                ret[k] = AsyncStage(self, 0x01, stage_name_from_get_hw_info(self._info_message))
+                self._stages[k] = ret[k]
+
+        return ret
@@ -0,0 +1,123 @@
+import struct
+import threading
+import time
+
+class WireCapture:
+    """Binary log of the bytes exchanged with a controller.
+
+    Every chunk of bytes read from or written to the serial port is recorded with its
+    :func:`time.monotonic_ns` timestamp and direction. :meth:`record` only copies the chunk into a
+    preallocated ring buffer; a background thread writes the buffer to the file. If the ring buffer
+    is full, the chunk is dropped and counted in :attr:`dropped`.
+
+    The file starts with :attr:`magic`, followed by records made of a header
+    ``<qBH`` (timestamp in ns, direction, length) and the bytes. Read it back with :meth:`read`.
+    """
+    RX = 0
+    TX = 1
+    magic = b'THORPYCAP1\n'
+    _record_header = struct.Struct('<qBH')
+
+    def __init__(self, path, buffer_size = 1 << 20, flush_interval = 0.1):
+        self.path = path
+        self.dropped = 0
+        self._file = open(path, 'wb')
+        self._file.write(self.magic)
+        self._buffer = bytearray(buffer_size)
+        self._capacity = buffer_size
+        self._view = memoryview(self._buffer)
+        #Total number of bytes put into the ring buffer, and written to the file
+        self._head = 0
+        self._tail = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flush_interval = flush_interval
+        self._closed = False
+        self._thread_main = threading.main_thread()
+        self._thread = threading.Thread(target = self._run, name = 'thorpy-capture')
+        self._thread.start()
+
+    def record(self, direction, data):
+        """Record data, sent (:attr:`TX`) or received (:attr:`RX`), with the current time"""
+        timestamp = time.monotonic_ns()
+        length = len(data)
+        if length > 0xffff:
+            for i in range(0, length, 0xffff):
+                self.record(direction, data[i:i + 0xffff])
+            return
+        size = 11 + length  #_record_header.size
+        capacity = self._capacity
+        with self._lock:
+            head = self._head
+            if head - self._tail + size > capacity or self._closed:
+                self.dropped += 1
+                return
+            position = head % capacity
+            if position + size <= capacity:
+                self._record_header.pack_into(self._view, position, timestamp, direction, length)
+                self._view[position + 11:position + size] = data
+                self._head = head + size
+            else:
+                #Wraps around the end of the buffer
+                self._put(self._record_header.pack(timestamp, direction, length))
+                self._put(data)
+            if self._head - self._tail > capacity >> 1 and not self._wakeup.is_set():
+                self._wakeup.set()
+
+    def _put(self, data):
+        position = self._head % len(self._buffer)
+        first = min(len(data), len(self._buffer) - position)
+        self._view[position:position + first] = data[:first]
+        if first < len(data):
+            self._view[:len(data) - first] = data[first:]
+        self._head += len(data)
+
+    def _flush(self):
+        with self._lock:
+            head = self._head
+        #Only this thread moves the tail, the bytes up to head are not overwritten before
+        start, end = self._tail % len(self._buffer), head % len(self._buffer)
+        if head - self._tail == 0:
+            return
+        if start < end:
+            self._file.write(self._view[start:end])
+        else:
+            self._file.write(self._view[start:])
+            self._file.write(self._view[:end])
+        with self._lock:
+            self._tail = head
+
+    def _run(self):
+        while not self._closed and self._thread_main.is_alive():
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self._flush()
+        self._flush()
+        self._file.close()
+
+    def close(self):
+        """Write the remaining records and close the file"""
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    @classmethod
+    def read(cls, path):
+        """Yield (timestamp in ns, direction, bytes) for every record of the capture file"""
+        with open(path, 'rb') as f:
+            if f.read(len(cls.magic)) != cls.magic:
+                raise ValueError("{0} is not a capture file".format(path))
+            while True:
+                header = f.read(cls._record_header.size)
+                if len(header) < cls._record_header.size:
+                    return
+                timestamp, direction, length = cls._record_header.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield timestamp, direction, data
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, self.path)
@@ -1,12 +1,16 @@
-def discover_stages():
-    import usb
-    import os
-    from .port import Port
+def _list_serial_ports():
+    """Return a list of (port, description, hwid dictionary), e.g. hwid['SER'] is the USB serial number"""
     from serial.tools.list_ports import comports
+    return [(x[0], x[1], dict(y.split('=', 1) for y in x[2].split(' ') if '=' in y)) for x in comports()]
+
+def _find_controller_ports(serial_ports = None):
+    """Yield (port, serial_number) for all the Thorlabs controllers connected over USB"""
+    import usb
     import platform
-    
-    serial_ports = [(x[0], x[1], dict(y.split('=', 1) for y in x[2].split(' ') if '=' in y)) for x in comports()]
-    
+
+    if serial_ports is None:
+        serial_ports = _list_serial_ports()
+
     for dev in usb.core.find(find_all=True, custom_match= lambda x: x.bDeviceClass != 9):
         try:
             #FIXME: this avoids an error related to https://github.com/walac/pyusb/issues/139
@@ -17,23 +21,160 @@ def discover_stages():
                 continue
         except usb.core.USBError:
             continue
-        
+
         if platform.system() == 'Linux':
             port_candidates = [x[0] for x in serial_ports if x[2].get('SER', None) == dev.serial_number]
         else:
             raise NotImplementedError("Implement for platform.system()=={0}".format(platform.system()))
-        
+
         assert len(port_candidates) == 1
-        
-        port = port_candidates[0]
 
-        p = Port.create(port, dev.serial_number)
-        for stage in p.get_stages().values():
-            yield stage
-        
+        yield port_candidates[0], dev.serial_number
+
+class DiscoveryCache:
+    """On-disk cache of the discovered controllers, keyed by USB serial number.
+
+    For every controller, the cache holds the tty path. Together with the list of serial ports, it allows to skip the USB enumeration (which reads
+    the manufacturer of every device) as long as the same serial ports are present and the
+    USB serial number in sysfs still matches for every cached tty.
+    """
+    def __init__(self, path = None):
+        import os
+        if path is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            path = os.path.join(cache_home, 'thorpy', 'discovery.json')
+        self.path = path
+        self._serial_ports = []
+        self._controllers = {}
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        import json
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self._serial_ports = [tuple(x) for x in data['serial_ports']]
+            self._controllers = data['controllers']
+        except (OSError, ValueError, KeyError, TypeError):
+            self._serial_ports, self._controllers = [], {}
+
+    def save(self):
+        if not self._dirty:
+            return
+        import json, os
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            #Write to a temporary file, so that concurrent processes never read a partial cache
+            tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump({'serial_ports': self._serial_ports, 'controllers': self._controllers}, f, indent = 1)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            return  #Read-only home, the USB devices are enumerated again next time
+        self._dirty = False
+
+    def controller_ports(self, serial_ports):
+        """Return the cached list of (port, serial_number), or None if the cache is not valid anymore"""
+        serial_ports = sorted((x[0], x[2].get('SER', None)) for x in serial_ports)
+        if serial_ports != self._serial_ports:
+            return None
+        for serial_number, entry in self._controllers.items():
+            if _sysfs_serial_number(entry['port']) != serial_number:
+                return None
+        return [(entry['port'], serial_number) for serial_number, entry in sorted(self._controllers.items())]
+
+    def update_ports(self, serial_ports, controller_ports):
+        """Store the result of an enumeration, entries of controllers not found anymore are removed"""
+        self._serial_ports = sorted((x[0], x[2].get('SER', None)) for x in serial_ports)
+        self._controllers = dict((serial_number, self._controllers.get(serial_number, {}))
+                                 for port, serial_number in controller_ports)
+        for port, serial_number in controller_ports:
+            self._controllers[serial_number]['port'] = port
+        self._dirty = True
+
+def _sysfs_serial_number(port):
+    """Return the serial number of the USB device of the tty port, as found in sysfs, or None"""
+    import os
+    device_path = os.path.realpath(os.path.join('/sys/class/tty', os.path.basename(port), 'device'))
+    #The tty is below the USB interface (ttyACM) or below a port of the interface (ttyUSB)
+    for path in (device_path, os.path.dirname(device_path), os.path.dirname(os.path.dirname(device_path))):
+        try:
+            with open(os.path.join(path, 'serial')) as f:
+                return f.read().strip()
+        except OSError:
+            pass
+    return None
+
+def _print_port_report(port, serial_number, duration, exception):
+    import sys
+    if exception is None:
+        print("Opened {0} ({1}) in {2:.2f}s".format(port, serial_number, duration))
+    else:
+        print("Failed to open {0} ({1}) after {2:.2f}s: {3!r}".format(port, serial_number, duration, exception), file = sys.stderr)
+
+def _open_port(port, serial_number):
+    """Open the port and create its stages, return (port object, stages, duration, exception)"""
+    import time
+    from .port import Port
+    start_time = time.time()
+    try:
+        p = Port.create(port, serial_number)
+        stages = list(p.get_stages().values())
+        return p, stages, time.time() - start_time, None
+    except Exception as e:
+        return None, [], time.time() - start_time, e
+
+def discover_stages(max_workers = None, report = _print_port_report, cache = True, emulators = ()):
+    """Open all the connected controllers concurrently and yield their stages as soon as each port is ready.
+
+    :param max_workers: maximum number of ports being opened at the same time, by default all of them
+    :param report: called as report(port, serial_number, duration, exception) when a port is opened
+        (exception is None) or failed to open. The other ports are not affected by a failure.
+    :param cache: a :class:`DiscoveryCache`, True for the default one, or False to always enumerate the USB devices
+    :param emulators: :class:`~thorpy.comm.emulator.ControllerEmulator` opened along with the USB controllers
+    """
+    import concurrent.futures
+
+    if cache is True:
+        cache = DiscoveryCache()
+    serial_ports = _list_serial_ports()
+    controllers = cache.controller_ports(serial_ports) if cache else None
+    if controllers is None:
+        import usb.core
+        try:
+            controllers = list(_find_controller_ports(serial_ports))
+            if cache:
+                cache.update_ports(serial_ports, controllers)
+        except usb.core.NoBackendError as e:
+            import sys
+            print("USB controllers not enumerated: {0}".format(e), file = sys.stderr)
+            controllers = []
+
+    #Emulated controllers are not USB devices, they are never cached
+    controllers = controllers + [(emulator.path, str(emulator.serial_number)) for emulator in emulators]
+
+    try:
+        if not controllers:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers or len(controllers)) as executor:
+            futures = dict((executor.submit(_open_port, port, serial_number), (port, serial_number))
+                           for port, serial_number in controllers)
+            for future in concurrent.futures.as_completed(futures):
+                port, serial_number = futures[future]
+                p, stages, duration, exception = future.result()
+                if report is not None:
+                    report(port, serial_number, duration, exception)
+                for stage in stages:
+                    yield stage
+    finally:
+        if cache:
+            cache.save()
+
 if __name__ == '__main__':
     print(list(discover_stages()))
-    
+
 
 #iManufacturer           1 Thorlabs
 #    iProduct                2 APT DC Motor Controller
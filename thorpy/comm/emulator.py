@@ -0,0 +1,312 @@
+import math
+import os
+import select
+import threading
+import time
+
+from .framer import Framer
+from ..message import *
+
+#Sampling period of the controller, see GenericStage._T
+_T = 2048 / 6e6
+
+class _Profile:
+    """Motion made of segments of constant acceleration: (duration, acceleration), starting at position and velocity"""
+    def __init__(self, start_time, position, velocity, segments):
+        self.start_time = start_time
+        self.position = position
+        self.velocity = velocity
+        self.segments = segments
+        self.end_time = start_time + sum(duration for duration, acceleration in segments)
+
+    @classmethod
+    def trapezoidal(cls, start_time, position, target, max_velocity, acceleration):
+        """Move from rest at position to rest at target"""
+        distance = abs(target - position)
+        direction = 1 if target >= position else -1
+        if distance == 0 or max_velocity <= 0 or acceleration <= 0:
+            return cls(start_time, target, 0, [])
+        if max_velocity ** 2 / acceleration > distance:
+            #Triangular profile, the maximum velocity is not reached
+            t_acc = math.sqrt(distance / acceleration)
+            t_cruise = 0
+        else:
+            t_acc = max_velocity / acceleration
+            t_cruise = (distance - max_velocity * t_acc) / max_velocity
+        segments = [(t_acc, direction * acceleration), (t_cruise, 0), (t_acc, -direction * acceleration)]
+        return cls(start_time, position, 0, segments)
+
+    @classmethod
+    def stop(cls, start_time, position, velocity, acceleration):
+        """Decelerate from velocity to rest"""
+        if velocity == 0 or acceleration <= 0:
+            return cls(start_time, position, 0, [])
+        return cls(start_time, position, velocity, [(abs(velocity) / acceleration, -math.copysign(acceleration, velocity))])
+
+    def state(self, now):
+        """Return (position, velocity) at time now"""
+        t = now - self.start_time
+        position, velocity = self.position, self.velocity
+        for duration, acceleration in self.segments:
+            if t <= 0:
+                break
+            dt = min(t, duration)
+            position += velocity * dt + acceleration * dt * dt / 2
+            velocity += acceleration * dt
+            t -= duration
+        if now >= self.end_time:
+            velocity = 0
+        return position, velocity
+
+class ControllerModel:
+    """State machine of a single channel DC servo controller (TDC001, KDC101), independent of any clock or transport.
+
+    :meth:`handle` takes a received message and the current time, and returns the messages to send back.
+    Between messages, :meth:`next_event_time` tells when the controller sends something on its own,
+    which :meth:`end_of_move` and :meth:`status_updates` return once that time is reached.
+
+    Moves (absolute, relative, home) follow a trapezoidal velocity profile computed from the velocity
+    parameters, stops are immediate or profiled. Once update messages are started, DCSTATUSUPDATE
+    messages are sent at status_rate per second. As the real controller, it stops sending status
+    updates after ack_limit of them without MOT_ACK_DCSTATUSUPDATE (None for no limit).
+
+    Positions are in encoder counts, velocity and acceleration parameters in APT units, as on the wire.
+    The defaults correspond to a MTS50-Z8 stage (34304 counts/mm).
+
+    :param on_message: called as on_message(msg) for every received message
+    """
+    def __init__(self, serial_number = 83000001, model_number = b'TDC001', stage_type = 0x08, hw_version = 1,
+                 status_rate = 10, ack_limit = 50, position = 0,
+                 min_velocity = 0, max_velocity = int(2.8 * 34304 * _T * 65536), acceleration = int(1.5 * 34304 * _T ** 2 * 65536),
+                 home_velocity = int(1.0 * 34304 * _T * 65536), home_offset_distance = 34304, on_message = None):
+        self.serial_number = serial_number
+        self.status_rate = status_rate
+        self.ack_limit = ack_limit
+        self.on_message = on_message
+        self.min_velocity = min_velocity
+        self.max_velocity = max_velocity
+        self.acceleration = acceleration
+        self.home_velocity = home_velocity
+        self.home_direction = 2
+        self.home_limit_switch = 1
+        self.home_offset_distance = home_offset_distance
+        self.move_absolute_position = 0
+        self.move_relative_distance = 0
+        self.homed = False
+        self.updates_enabled = False
+        self.unacknowledged_updates = 0
+        self._profile = _Profile(0, position, 0, [])
+        #Message sent once the current profile ends: MOVE_COMPLETED, MOVE_HOMED or MOVE_STOPPED
+        self._end_of_move = None
+        self._homing = False
+        self._next_update = None
+        self.info = MGMSG_HW_GET_INFO(serial_number = serial_number, model_number = model_number, type = 16,
+                                      firmware_version = b'\x01\x02\x03\x00', notes = b'',
+                                      empty_space = b'\x00' * 10 + bytes([stage_type, 0]),
+                                      hw_version = hw_version, mod_state = 0, nchs = 1, source = 0x50, dest = 0x01)
+
+    def state(self, now):
+        """Return (position, velocity) at time now, in encoder counts and counts per second"""
+        return self._profile.state(now)
+
+    def in_motion(self, now):
+        return now < self._profile.end_time
+
+    def _status_bits(self, now):
+        position, velocity = self._profile.state(now)
+        bits = 0x80000000  #Channel enabled
+        if velocity > 0:
+            bits |= 0x10
+        elif velocity < 0:
+            bits |= 0x20
+        if self._homing and now < self._profile.end_time:
+            bits |= 0x200
+        if self.homed:
+            bits |= 0x400
+        return bits
+
+    def status(self, now, message_class = MGMSG_MOT_GET_DCSTATUSUPDATE):
+        position, velocity = self._profile.state(now)
+        values = dict(chan_ident = 1, position = int(round(position)), status_bits = self._status_bits(now), source = 0x50, dest = 0x01)
+        if message_class is MGMSG_MOT_GET_DCSTATUSUPDATE:
+            values['velocity'] = max(-32768, min(32767, int(velocity * _T)))
+        return message_class(**values)
+
+    def _move(self, targets, end_of_move, now):
+        """Move through targets, a list of (position, velocity parameter)"""
+        start = position = self._profile.state(now)[0]
+        segments = []
+        for target, velocity in targets:
+            segments += _Profile.trapezoidal(now, position, target, velocity / (_T * 65536), self.acceleration / (_T ** 2 * 65536)).segments
+            position = target
+        self._profile = _Profile(now, start, 0, segments)
+        self._end_of_move = end_of_move
+
+    def handle(self, msg, now):
+        """Return the list of messages sent in response to msg"""
+        if self.on_message is not None:
+            self.on_message(msg)
+
+        if isinstance(msg, MGMSG_HW_REQ_INFO):
+            return [self.info]
+        elif isinstance(msg, MGMSG_HW_START_UPDATEMSGS):
+            self.updates_enabled = True
+            self.unacknowledged_updates = 0
+            self._next_update = now
+        elif isinstance(msg, MGMSG_HW_STOP_UPDATEMSGS):
+            self.updates_enabled = False
+        elif isinstance(msg, MGMSG_MOT_ACK_DCSTATUSUPDATE):
+            self.unacknowledged_updates = 0
+        elif isinstance(msg, MGMSG_MOT_REQ_DCSTATUSUPDATE):
+            return [self.status(now)]
+        elif isinstance(msg, MGMSG_MOT_REQ_VELPARAMS):
+            return [MGMSG_MOT_GET_VELPARAMS(chan_ident = 1, min_velocity = self.min_velocity, acceleration = self.acceleration,
+                                            max_velocity = self.max_velocity, source = 0x50, dest = 0x01)]
+        elif isinstance(msg, MGMSG_MOT_SET_VELPARAMS):
+            self.min_velocity, self.acceleration, self.max_velocity = msg['min_velocity'], msg['acceleration'], msg['max_velocity']
+        elif isinstance(msg, MGMSG_MOT_REQ_HOMEPARAMS):
+            return [MGMSG_MOT_GET_HOMEPARAMS(chan_ident = 1, home_direction = self.home_direction, limit_switch = self.home_limit_switch,
+                                             home_velocity = self.home_velocity, offset_distance = self.home_offset_distance,
+                                             source = 0x50, dest = 0x01)]
+        elif isinstance(msg, MGMSG_MOT_SET_HOMEPARAMS):
+            self.home_direction, self.home_limit_switch = msg['home_direction'], msg['limit_switch']
+            self.home_velocity, self.home_offset_distance = msg['home_velocity'], msg['offset_distance']
+        elif isinstance(msg, MGMSG_MOT_SET_MOVEABSPARAMS):
+            self.move_absolute_position = msg['absolute_position']
+        elif isinstance(msg, MGMSG_MOT_SET_MOVERELPARAMS):
+            self.move_relative_distance = msg['relative_distance']
+        elif isinstance(msg, (MGMSG_MOT_MOVE_ABSOLUTE_long, MGMSG_MOT_MOVE_ABSOLUTE_short)):
+            target = msg['absolute_distance'] if isinstance(msg, MGMSG_MOT_MOVE_ABSOLUTE_long) else self.move_absolute_position
+            self._homing = False
+            self._move([(target, self.max_velocity)], MGMSG_MOT_MOVE_COMPLETED, now)
+        elif isinstance(msg, (MGMSG_MOT_MOVE_RELATIVE_long, MGMSG_MOT_MOVE_RELATIVE_short)):
+            distance = msg['relative_distance'] if isinstance(msg, MGMSG_MOT_MOVE_RELATIVE_long) else self.move_relative_distance
+            position, velocity = self._profile.state(now)
+            self._homing = False
+            self._move([(position + distance, self.max_velocity)], MGMSG_MOT_MOVE_COMPLETED, now)
+        elif isinstance(msg, MGMSG_MOT_MOVE_HOME):
+            #Back to the reverse limit switch at home velocity, then to the home position offset_distance
+            #away from it, where the position counter is reset
+            self._homing = True
+            self.homed = False
+            self._move([(-self.home_offset_distance, self.home_velocity), (0, self.max_velocity)], MGMSG_MOT_MOVE_HOMED, now)
+        elif isinstance(msg, MGMSG_MOT_MOVE_STOP):
+            position, velocity = self._profile.state(now)
+            if msg['stop_mode'] == 0x01:
+                self._profile = _Profile(now, position, 0, [])
+            else:
+                self._profile = _Profile.stop(now, position, velocity, self.acceleration / (_T ** 2 * 65536))
+            self._homing = False
+            self._end_of_move = MGMSG_MOT_MOVE_STOPPED
+        return []
+
+    def next_event_time(self):
+        """Return the time of the next message sent on the controller's own initiative, or None"""
+        times = []
+        if self._end_of_move is not None:
+            times.append(self._profile.end_time)
+        if self.updates_enabled and self.status_rate:
+            times.append(self._next_update)
+        return min(times) if times else None
+
+    def end_of_move_time(self):
+        """Return the time at which the current move ends and its message is sent, or None"""
+        return None if self._end_of_move is None else self._profile.end_time
+
+    def end_of_move(self, now):
+        """Return the message sent at the end of the current move if it ended at now, or None"""
+        if self._end_of_move is None or now < self._profile.end_time:
+            return None
+        end_of_move, self._end_of_move = self._end_of_move, None
+        if end_of_move is MGMSG_MOT_MOVE_HOMED:
+            self._homing = False
+            self.homed = True
+            self._profile = _Profile(now, 0, 0, [])
+        #Always sent, only the status updates need to be acknowledged
+        if end_of_move is MGMSG_MOT_MOVE_HOMED:
+            return MGMSG_MOT_MOVE_HOMED(chan_ident = 1, source = 0x50, dest = 0x01)
+        return self.status(now, end_of_move)
+
+    def status_updates(self, now):
+        """Return (status update, count) for the updates due at now, count is 0 if there is none"""
+        if not (self.updates_enabled and self.status_rate) or now < self._next_update:
+            return None, 0
+        #Several updates are due at high rates, or after a long wait
+        count = int((now - self._next_update) * self.status_rate) + 1
+        self._next_update += count / self.status_rate
+        if self.ack_limit is not None:
+            count = max(0, min(count, self.ack_limit - self.unacknowledged_updates))
+        if not count:
+            return None, 0
+        self.unacknowledged_updates += count
+        return self.status(now), count
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(self.__class__.__name__, self.serial_number)
+
+class ControllerEmulator(ControllerModel):
+    """:class:`ControllerModel` behind a Linux pseudo-terminal, running in real time in its own thread.
+
+    The emulator answers the messages sent by :class:`~thorpy.comm.port.Port` and
+    :class:`~thorpy.stages.GenericStage` on the tty :attr:`path`, so that ``Port.create(emulator.path, sn)``
+    and :func:`~thorpy.comm.discovery.discover_stages` (given the emulator in emulators) work as with a real controller.
+    The parameters are those of :class:`ControllerModel`, on_message is called from the emulator thread.
+    """
+    def __init__(self, *args, **kwargs):
+        import pty, tty
+        super().__init__(*args, **kwargs)
+        self._profile = _Profile(time.monotonic(), self._profile.position, 0, [])
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.path = os.ttyname(self._slave)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target = self._run, name = 'thorpy-emulator-{0}'.format(self.serial_number), daemon = True)
+        self._thread.start()
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def position(self):
+        """Current position, in encoder counts"""
+        return int(round(self.state(time.monotonic())[0]))
+
+    def _run(self):
+        framer = Framer()
+        while not self._stopped.is_set():
+            timeout = 0.05
+            next_event_time = self.next_event_time()
+            if next_event_time is not None:
+                #At high status rates, the updates are sent by batches every millisecond
+                timeout = min(timeout, max(0.001 if self.updates_enabled else 0, next_event_time - time.monotonic()))
+            r, w, e = select.select([self._master], [], [], timeout)
+            if r:
+                framer.feed(os.read(self._master, 4096))
+
+            now = time.monotonic()
+            output = []
+            for msg in framer.read_messages():
+                output.extend(bytes(response) for response in self.handle(msg, now))
+            msg = self.end_of_move(now)
+            if msg is not None:
+                output.append(bytes(msg))
+            msg, count = self.status_updates(now)
+            if count:
+                output.append(bytes(msg) * count)
+
+            if output:
+                os.write(self._master, b''.join(output))
+
+    def __repr__(self):
+        return '<{0} {1} on {2}>'.format(self.__class__.__name__, self.serial_number, self.path)
@@ -0,0 +1,65 @@
+import collections
+
+from ..message import Message
+
+class Framer:
+    """Splits a stream of received bytes into messages.
+
+    Bytes are appended with :meth:`feed`, complete messages are parsed in place from the internal
+    buffer. Consumed bytes are only removed from the buffer once it is drained or once
+    at least :attr:`compact_size` bytes have been consumed.
+
+    Unknown messages are skipped using the length in their header, and corrupt bytes are skipped
+    until a valid header is found again. Both are counted in :attr:`skipped_frames` and
+    :attr:`skipped_bytes`.
+    """
+    compact_size = 4096
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0
+        self._pending = collections.deque()
+        self.skipped_frames = 0
+        self.skipped_bytes = 0
+
+    def __len__(self):
+        """Number of bytes received, but not yet parsed"""
+        return len(self._buffer) - self._offset
+
+    def feed(self, data):
+        self._buffer += data
+
+    def clear(self):
+        self._buffer.clear()
+        self._offset = 0
+        self._pending.clear()
+
+    def read_message(self):
+        """Return the next complete message, or None if there is none yet"""
+        if not self._pending:
+            self._pending.extend(self._parse())
+        return self._pending.popleft() if self._pending else None
+
+    def read_messages(self):
+        """Return the list of all complete messages"""
+        messages = self._parse()
+        if self._pending:
+            messages[:0] = self._pending
+            self._pending.clear()
+        return messages
+
+    def _parse(self):
+        messages, offset = Message.parse_many(self._buffer, self._offset, self._on_skip)
+        self._offset = offset
+        if offset == len(self._buffer):
+            self._buffer.clear()
+            self._offset = 0
+        elif offset >= self.compact_size:
+            del self._buffer[:offset]
+            self._offset = 0
+        return messages
+
+    def _on_skip(self, offset, length, is_frame):
+        self.skipped_bytes += length
+        if is_frame:
+            self.skipped_frames += 1
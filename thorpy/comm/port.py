@@ -1,3 +1,4 @@
+import concurrent.futures
 import serial
 import select
 import threading
@@ -5,160 +6,453 @@ import time
 import queue
 import weakref
 
+from .framer import Framer
+from .subscription import Subscription
+
 class Port:
     #List to make "quasi-singletons"
     static_port_list = weakref.WeakValueDictionary()
     static_port_list_lock = threading.RLock()
+    #Port name -> lock serializing the construction of that port. Transport objects (e.g. a ReplayTransport)
+    #are not kept here, they would never be removed, and each one is opened by a single caller.
+    static_port_locks = {}
+    
+    #Bring-up handshake: the input is drained until no byte arrives for handshake_quiet_time (at most
+    #handshake_drain_timeout), then HW_REQ_INFO is sent up to handshake_info_retries times.
+    #RTS is held high for handshake_rts_pulse while the buffers are reset, so that the controller sees the pulse.
+    handshake_rts_pulse = 0.05
+    handshake_quiet_time = 0.05
+    handshake_drain_timeout = 1
+    handshake_info_timeout = 0.5
+    handshake_info_retries = 5
+    
+    #Reactor serving the ports created without an explicit one, see :class:`~thorpy.comm.reactor.Reactor`.
+    #None means that every port runs its own worker thread.
+    default_reactor = None
+    
+    #Maximum number of unhandled messages kept for recv_message, the oldest ones are dropped
+    unhandled_messages_maxsize = 1000
+    
+    #Clock used by the stages to wait, see :class:`~thorpy.comm.simulation.VirtualClock`
+    clock = time
     
-    def __init__(self, port, sn):
+    def __init__(self, port, sn, reactor = None, capture = None):
         super().__init__()
-        self._lock = threading.RLock()
-        self._lock.acquire()
-        self._buffer = b''
-        self._unhandled_messages = queue.Queue()
-        self._serial = serial.Serial(port,
-                                     baudrate=115200,
-                                     bytesize=serial.EIGHTBITS,
-                                     parity=serial.PARITY_NONE,
-                                     stopbits=serial.STOPBITS_ONE,
-                                     rtscts=True)
+        #The receive path (reader thread) and the transmit path (writer thread) never share a lock
+        self._rx_lock = threading.RLock()
+        self._tx_queue = queue.Queue()
+        #Serializes the writes of the callers, in reactor mode
+        self._tx_lock = threading.Lock()
+        self._framer = Framer()
+        #Pending requests: (response class, chan_ident) -> list of futures
+        self._requests = {}
+        self._requests_lock = threading.Lock()
+        #(message class or None, chan_ident or None) -> list of subscriptions, replaced on every change
+        self._subscriptions = {}
+        self._subscriptions_lock = threading.Lock()
+        self._unhandled_messages = Subscription(maxsize = self.unhandled_messages_maxsize)
+        self._capture = None
+        self._serial = Port._open_serial(port)
+        if capture is not None:
+            self.start_capture(capture)
 
         # The Thorlabs protocol description recommends toggeling the RTS pin and resetting the
         # input and output buffer. This makes sense, since the internal controller of the Thorlabs
         # device does not know what data has reached us of the FTDI RS232 converter.
         # Similarly, we do not know the state of the controller input buffer.
         # Be toggling the RTS pin, we let the controller know that it should flush its caches.
-        self._serial.setRTS(1)
-        time.sleep(0.05)
+        rts_start_time = time.time()
+        has_rts = Port._set_rts(self._serial, 1)
         self._serial.reset_input_buffer()
         self._serial.reset_output_buffer()
-        time.sleep(0.05)
-        self._serial.setRTS(0)
+        if has_rts:
+            time.sleep(max(0, self.handshake_rts_pulse - (time.time() - rts_start_time)))
+        Port._set_rts(self._serial, 0)
 
         self._port = port
+        self._serial_number = int(sn)
         self._debug = False
         
-        from ..message import MGMSG_HW_NO_FLASH_PROGRAMMING, MGMSG_HW_REQ_INFO, MGMSG_HW_START_UPDATEMSGS, MGMSG_HW_STOP_UPDATEMSGS
+        #The threads stop with the main thread, ports may be created from other threads (e.g. by discover_stages)
+        self._thread_main = threading.main_thread()
+        #Exception which stopped the writes, raised again by every send
+        self._write_error = None
+        #With a reactor, there is no thread per port: the callers write directly, the messages are small
+        #enough for the serial port not to block. Otherwise, a writer thread sends the queued messages.
+        self._reactor = reactor if reactor is not None else Port.default_reactor
+        if self._reactor is None:
+            self._thread_writer = threading.Thread(target = Port._run_writer, args = (weakref.proxy(self), self._tx_queue))
+            self._thread_writer.start()
+        else:
+            self._thread_writer = None
+        
+        from ..message import MGMSG_HW_NO_FLASH_PROGRAMMING, MGMSG_HW_START_UPDATEMSGS, MGMSG_HW_STOP_UPDATEMSGS
         self.send_message(MGMSG_HW_NO_FLASH_PROGRAMMING(source = 0x01, dest = 0x50))
 
         # Now that the input buffer of the device is flushed, we can tell it to stop reporting updates and
         # then flush away any remaining messages.
         self.send_message(MGMSG_HW_STOP_UPDATEMSGS())
-        time.sleep(0.5)
-        self._serial.reset_input_buffer()
+        self._drain_input()
 
-        self._info_message = None
-        while self._info_message is None:
-            self.send_message(MGMSG_HW_REQ_INFO())
-            try:
-                self._info_message = self._recv_message(blocking = True)
-            except: # TODO: Be more specific on what we catch here
-                self._buffer = b''
-                self._serial.flushInput()
+        #On failure, the writer thread is stopped by __del__ and the serial port closed
+        self._info_message = self._request_info()
                 
-        self._serial_number = int(sn)
         if self._serial_number is None:
             self._serial_number = self._info_message['serial_number']
             
-        time.sleep(1)
-            
         self.send_message(MGMSG_HW_START_UPDATEMSGS(update_rate = 1))
             
         self._stages = weakref.WeakValueDictionary()
         
-        self._lock.release()
         self.daemon = False
         print("Constructed: {0!r}".format(self))
         
-        self._thread_main = threading.current_thread()
-        self._thread_worker_initialized = threading.Event()
-        self._thread_worker = threading.Thread(target = Port.run, args = (weakref.proxy(self), ))
-        self._thread_worker.start()
+        self._continue = True
+        if self._reactor is not None:
+            self._reactor_fd = self._serial.fileno()
+            self._reactor.register(self._reactor_fd, weakref.WeakMethod(self._process_received))
+        else:
+            self._thread_worker_initialized = threading.Event()
+            self._thread_worker = threading.Thread(target = Port.run, args = (weakref.proxy(self), ))
+            self._thread_worker.start()
+            
+            self._thread_worker_initialized.wait()
         
-        self._thread_worker_initialized.wait()
+
+    def _drain_input(self):
+        """Discard the received bytes until the input has been quiet for :attr:`handshake_quiet_time`"""
+        start_time = time.time()
+        while time.time() - start_time < self.handshake_drain_timeout:
+            r, w, e = select.select([self._serial], [], [], self.handshake_quiet_time)
+            if len(r) == 0:
+                break
+            data = self._serial.read(self._serial.in_waiting or 1)
+            if self._capture is not None:
+                self._capture.record(self._capture.RX, data)
+        self._framer.clear()
         
+    def _request_info(self):
+        """Send HW_REQ_INFO until HW_GET_INFO is received, other messages are discarded"""
+        from ..message import MGMSG_HW_REQ_INFO, MGMSG_HW_GET_INFO
+        for attempt in range(self.handshake_info_retries):
+            self.send_message(MGMSG_HW_REQ_INFO())
+            deadline = time.time() + self.handshake_info_timeout
+            while True:
+                msg = self._recv_message(blocking = True, timeout = deadline - time.time())
+                if msg is None:
+                    break
+                if isinstance(msg, MGMSG_HW_GET_INFO):
+                    return msg
+        raise TimeoutError("No answer to HW_REQ_INFO on {0} after {1} attempts".format(self._port, self.handshake_info_retries))
+
+    @staticmethod
+    def _open_serial(port):
+        if not isinstance(port, str):
+            return port  #Already opened transport, e.g. a ReplayTransport
+        return serial.Serial(port,
+                             baudrate=115200,
+                             bytesize=serial.EIGHTBITS,
+                             parity=serial.PARITY_NONE,
+                             stopbits=serial.STOPBITS_ONE,
+                             rtscts=True)
+    
+    @staticmethod
+    def _set_rts(serial_port, level):
+        """Set the RTS pin, return whether the port has one"""
+        try:
+            serial_port.setRTS(level)
+            return True
+        except OSError:
+            return False  #Pseudo terminals (e.g. emulated controllers) have no RTS pin, the flush is enough for them.
 
     def __del__(self):
         print("Destructed: {0!r}".format(self))
-        self._thread_worker.join()
+        self.stop_capture()
+        for subscriptions in self._subscriptions.values():
+            for subscription in subscriptions:
+                subscription.close()
+        self._unhandled_messages.close()
+        self._continue = False
+        if self._thread_writer is not None:
+            self._tx_queue.put(None)
+            self._thread_writer.join()
+        #The worker thread closes the serial port, the last reference may be dropped by the worker thread itself
+        if hasattr(self, '_thread_worker'):
+            if threading.current_thread() is not self._thread_worker:
+                self._thread_worker.join()
+        else:
+            #Reactor mode, or the handshake failed before the worker thread was started
+            try:
+                if hasattr(self, '_reactor_fd'):
+                    self._reactor.unregister(self._reactor_fd)
+            finally:
+                self._serial.close()
             
     def send_message(self, msg):
-        with self._lock:
-            if self._debug:
-                print('> ', msg)
-            self._serial.write(bytes(msg))
+        """Send msg (queued for the writer thread, unless in reactor mode), this never waits for the reader thread"""
+        if self._debug:
+            print('> ', msg)
+        self._send(bytes(msg))
+            
+    def send_bytes(self, data):
+        """Send an already encoded message, e.g. from a :class:`~thorpy.message.MessageTemplate`"""
+        if self._debug:
+            from ..message import Message
+            print('> ', Message.parse(data))
+        self._send(data)
+    
+    def _send(self, data):
+        self._check_writer()
+        if self._thread_writer is not None:
+            self._tx_queue.put(data)
+            return
+        with self._tx_lock:
+            if not self._write(data):
+                self._check_writer()
+    
+    def _write(self, data):
+        """Write data to the serial port, return False if it failed (the port then stops sending)"""
+        #Recorded before writing, the answer could otherwise be recorded before the frame which caused it
+        capture = self._capture
+        if capture is not None:
+            capture.record(capture.TX, data)
+        try:
+            self._serial.write(data)
+        except OSError as e:  #Including serial.SerialException, e.g. the device was unplugged
+            self._fail_writer(e)
+            return False
+        return True
+            
+    @staticmethod
+    def _run_writer(self, tx_queue):
+        try:
+            while self._thread_main.is_alive():
+                try:
+                    data = tx_queue.get(timeout = 1)
+                except queue.Empty:
+                    continue
+                if data is None or not self._write(data):
+                    break
+        except ReferenceError:
+            pass  #Object deleted
+    
+    def _write_exception(self):
+        return serial.SerialException("Cannot write to {0}: {1}".format(self._port, self._write_error))
+    
+    def _check_writer(self):
+        if self._write_error is not None:
+            raise self._write_exception() from self._write_error
+    
+    def _fail_writer(self, error):
+        """Called when a write fails, the pending requests fail immediately"""
+        self._write_error = error
+        with self._requests_lock:
+            requests, self._requests = self._requests, {}
+        for futures in requests.values():
+            for future in futures:
+                if not future.done():
+                    exception = self._write_exception()
+                    exception.__cause__ = error
+                    future.set_exception(exception)
             
     @staticmethod
     def run(self):
         try:
-            self._continue = True
             timeout = 1
             self._thread_worker_initialized.set()
             
-            while self._thread_main.is_alive():
+            while self._continue and self._thread_main.is_alive():
                 #Trick to avoid holding lock
                 r, w, e = select.select([self._serial], [], [], timeout)
-                msg = self._recv_message(False)
-                if msg is not None:
-                    message_handled = self._handle_message(msg)
-                    if not message_handled:
-                        print("Unhandled message", msg)
-                        self._unhandled_messages.put(msg)
+                self._process_received()
                         
             self._serial.close()
         except ReferenceError:
             pass  #Object deleted
 
         
-    def _recv(self, l = 1, blocking = False):
-        with self._lock:
-            if not blocking:
-                r, w, e = select.select([self._serial], [], [], 0)
+    def _process_received(self):
+        """Handle the received messages, called by the worker thread or the reactor"""
+        for msg in self._recv_messages():
+            message_handled = self._handle_message(msg)
+            if self._requests:
+                message_handled = self._resolve_requests(msg) or message_handled
+            if self._subscriptions:
+                self._publish(msg)
+            if not message_handled:
+                if self._debug:
+                    print("Unhandled message", msg)
+                self._unhandled_messages._deliver(msg)
+        
+    def _recv(self, l = 1, blocking = False, timeout = None):
+        """Read all available bytes, or wait for at least l bytes (at most timeout seconds) if blocking"""
+        with self._rx_lock:
+            if not blocking or timeout is not None:
+                r, w, e = select.select([self._serial], [], [], max(timeout, 0) if blocking else 0)
                 if len(r) == 0:
                     return 0
                 
-            new_data = self._serial.read(l)
-            self._buffer += new_data
+            new_data = self._serial.read(max(l, self._serial.in_waiting))
+            self._framer.feed(new_data)
+            capture = self._capture
+            if capture is not None:
+                capture.record(capture.RX, new_data)
             return len(new_data)
         
         
     def fileno(self):
-        with self._lock:
-            return self._serial.fileno()
+        return self._serial.fileno()
         
+    def start_capture(self, path, **kwargs):
+        """Record the bytes exchanged with the controller to path, see :class:`~thorpy.comm.capture.WireCapture`"""
+        from .capture import WireCapture
+        self.stop_capture()
+        self._capture = WireCapture(path, **kwargs)
+        return self._capture
+    
+    def stop_capture(self):
+        capture, self._capture = self._capture, None
+        if capture is not None:
+            capture.close()
+    
     def recv_message(self, block = True, timeout = None):
-        try:
-            return self._unhandled_messages.get(block, timeout)
-        except queue.Empty:
-            return None
+        """Return the next message which was not handled by the port, its stages or a request"""
+        return self._unhandled_messages.get(timeout if block else 0)
+    
+    def subscribe(self, message_class = None, chan_ident = None, callback = None, maxsize = 1000, overflow = Subscription.DROP_OLDEST):
+        """Receive the messages of message_class on channel chan_ident (None for all), handled or not.
+        
+        See :class:`~thorpy.comm.subscription.Subscription` for callback, maxsize and overflow.
+        
+        :return: the subscription, pass it to :meth:`unsubscribe` to stop it
+        """
+        subscription = Subscription(message_class, chan_ident, callback, maxsize, overflow)
+        with self._subscriptions_lock:
+            subscriptions = dict(self._subscriptions)
+            subscriptions[subscription.key] = subscriptions.get(subscription.key, []) + [subscription]
+            self._subscriptions = subscriptions
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        with self._subscriptions_lock:
+            subscriptions = dict(self._subscriptions)
+            remaining = [x for x in subscriptions.get(subscription.key, []) if x is not subscription]
+            if remaining:
+                subscriptions[subscription.key] = remaining
+            else:
+                subscriptions.pop(subscription.key, None)
+            self._subscriptions = subscriptions
+        subscription.close()
+    
+    def _publish(self, msg):
+        subscriptions = self._subscriptions
+        msg_cls = type(msg)
+        keys = [(msg_cls, None), (None, None)]
+        if 'chan_ident' in msg:
+            keys += [(msg_cls, msg['chan_ident']), (None, msg['chan_ident'])]
+        for key in keys:
+            for subscription in subscriptions.get(key, ()):
+                subscription._deliver(msg)
+    
+    def _recv_messages(self):
+        """Read the available bytes and return all the complete messages, without blocking"""
+        with self._rx_lock:
+            self._recv()
+            messages = self._framer.read_messages()
+            
+            if self._debug:
+                for msg in messages:
+                    print('< ', msg)
+            return messages
     
     def _recv_message(self, blocking = False, timeout = None):
-        with self._lock:
-            from ..message import Message, IncompleteMessageException
-            msg = None
+        with self._rx_lock:
             start_time = time.time()
+            msg = self._framer.read_message()
             while msg is None:
-                try:
-                    msg = Message.parse(self._buffer)
-                except IncompleteMessageException:
-                    msg = None
-                    length = self._recv(blocking = blocking)
-                    
-                    #We were not able to read data
-                    if length == 0 and not blocking:
-                        return None
-                    
-                    #Passed timeout...
-                    if blocking and timeout is not None and start_time < time.time() - timeout:
-                        return None
-                    
-            
-            self._buffer = self._buffer[len(msg):]
+                remaining = None if timeout is None else timeout - (time.time() - start_time)
+                length = self._recv(blocking = blocking, timeout = remaining)
+                
+                #We were not able to read data
+                if length == 0 and (not blocking or remaining is not None):
+                    return None
+                
+                msg = self._framer.read_message()
             
             if self._debug:
                 print('< ', msg)
             return msg
         
+    @staticmethod
+    def _request_parameters(msg, response_classes):
+        """Return the response classes and the fixed parameters of the request msg, see :meth:`request`"""
+        from ..message import MessageTemplate
+        if isinstance(msg, MessageTemplate):
+            msg_cls, parameters = msg.message_class, msg.fixed
+            if 'chan_ident' in msg.varying:
+                raise ValueError("Cannot request with a {0} template whose chan_ident is varying, "
+                                 "fix chan_ident in the template".format(msg_cls.__name__))
+        else:
+            msg_cls, parameters = type(msg), msg
+        if response_classes is None:
+            if msg_cls.response_class is None:
+                raise ValueError("{0} is not a REQ message, response_classes must be given".format(msg_cls.__name__))
+            response_classes = (msg_cls.response_class, )
+        return response_classes, parameters
+    
+    def request(self, msg, timeout = None, response_classes = None, values = ()):
+        """Send a REQ message and wait for the matching GET message on the same channel.
+        
+        The waiting thread is woken up by the worker thread as soon as the response is decoded.
+        
+        :param msg: the request, a :class:`~thorpy.message.Message` or :class:`~thorpy.message.MessageTemplate`
+        :param response_classes: the classes of the accepted responses, by default msg.response_class
+        :param values: the values of the varying parameters, if msg is a template
+        :return: the response, or None if it did not arrive within timeout
+        :raises ValueError: if msg is not a REQ message and response_classes is not given, or if msg is a template
+                            whose chan_ident is varying (the channel of the response would be unknown)
+        :raises serial.SerialException: if the request could not be written, e.g. the device was unplugged
+        """
+        from ..message import MessageTemplate
+        response_classes, parameters = self._request_parameters(msg, response_classes)
+        keys = [(cls, parameters['chan_ident'] if 'chan_ident' in cls.parameter_names else None)
+                for cls in response_classes]
+        
+        future = concurrent.futures.Future()
+        with self._requests_lock:
+            for key in keys:
+                self._requests.setdefault(key, []).append(future)
+        
+        if isinstance(msg, MessageTemplate):
+            self.send_bytes(msg.encode(*values))
+        else:
+            self.send_message(msg)
+        
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+        finally:
+            with self._requests_lock:
+                for key in keys:
+                    futures = self._requests.get(key, [])
+                    if future in futures:
+                        futures.remove(future)
+                    if not futures:
+                        self._requests.pop(key, None)
+        
+    def _resolve_requests(self, msg):
+        """Complete the pending requests waiting for msg, return whether there were any"""
+        key = (type(msg), msg['chan_ident'] if 'chan_ident' in msg else None)
+        with self._requests_lock:
+            futures = self._requests.pop(key, None)
+        if not futures:
+            return False
+        for future in futures:
+            if not future.done():
+                future.set_result(msg)
+        return True
+        
     @property
     def serial_number(self):
         return self._serial_number
@@ -168,6 +462,21 @@ class Port:
         #_info_message is immutable, no worries about lock
         return self._info_message['nchs']
     
+    @property
+    def skipped_frames(self):
+        """Number of received messages which were skipped, because they were unknown or invalid"""
+        return self._framer.skipped_frames
+    
+    @property
+    def skipped_bytes(self):
+        """Number of received bytes which were skipped, including those of skipped messages"""
+        return self._framer.skipped_bytes
+    
+    @property
+    def dropped_unhandled_messages(self):
+        """Number of unhandled messages dropped because :meth:`recv_message` was not called often enough"""
+        return self._unhandled_messages.dropped
+    
     def _handle_message(self, msg):
         return False
     
@@ -178,28 +487,44 @@ class Port:
         return {}
     
     @classmethod
-    def create(cls, port, sn):
-        with Port.static_port_list_lock:
-            try:
-                return Port.static_port_list[port]
-            except KeyError:
-                #Do we have a BSC103 or BBD10x? These are card slot controllers
-                if sn[:2] in ('70', '73', '94'):
-                    p = CardSlotPort(port, sn)
-                else:
-                    p = SingleControllerPort(port, sn)
+    def create(cls, port, sn, reactor = None, capture = None):
+        """Return the port object of port, opening it if needed.
+        
+        :param port: name of the serial port, or an object with the interface of :class:`serial.Serial`
+            such as :class:`~thorpy.comm.replay.ReplayTransport`
+        :param reactor: see :class:`~thorpy.comm.reactor.Reactor`
+        :param capture: path of a wire capture recording everything from the handshake on, see :meth:`start_capture`
+        """
+        #Only the construction of the same port is serialized, different ports can be opened concurrently
+        if isinstance(port, str):
+            with Port.static_port_list_lock:
+                port_lock = Port.static_port_locks.setdefault(port, threading.Lock())
+        else:
+            port_lock = threading.Lock()
+        with port_lock:
+            with Port.static_port_list_lock:
+                p = Port.static_port_list.get(port, None)
+            if p is not None:
+                return p
+            
+            #Do we have a BSC103 or BBD10x? These are card slot controllers
+            if sn[:2] in ('70', '73', '94'):
+                p = CardSlotPort(port, sn, reactor, capture)
+            else:
+                p = SingleControllerPort(port, sn, reactor, capture)
             
+            with Port.static_port_list_lock:
                 Port.static_port_list[port] = p
             
-                return p
+            return p
 
 class CardSlotPort(Port):
-    def __init__(self, port, sn = None):
+    def __init__(self, port, sn = None, reactor = None, capture = None):
         raise NotImplementedError("Card slot ports are not supported yet")
 
 class SingleControllerPort(Port):
-    def __init__(self, port, sn = None):
-        super().__init__(port, sn)
+    def __init__(self, port, sn = None, reactor = None, capture = None):
+        super().__init__(port, sn, reactor, capture)
         
         if self.channel_count != 1:
             raise NotImplementedError("Multiple channel devices are not supported yet")
@@ -210,8 +535,12 @@ class SingleControllerPort(Port):
         msg.dest = 0x50
         super().send_message(msg)
         
-    def _recv_message(self, blocking = False):
-        msg = super()._recv_message(blocking)
+    def template(self, msg_cls, *varying, **fixed):
+        """Return a pre-encoded message addressed to this controller, see :meth:`thorpy.message.Message.template`"""
+        return msg_cls.template(*varying, source = 0x01, dest = 0x50, **fixed)
+        
+    def _recv_message(self, blocking = False, timeout = None):
+        msg = super()._recv_message(blocking, timeout)
         if msg is None:
             return msg
         
@@ -0,0 +1,131 @@
+import os
+import selectors
+import threading
+import traceback
+import weakref
+
+class Reactor:
+    """Single thread waiting on the serial ports of many :class:`~thorpy.comm.port.Port` objects.
+
+    Without a reactor, every port runs its own worker thread. With a reactor, all the registered
+    ports are multiplexed with :mod:`selectors` (epoll on Linux) in one thread, which calls the
+    handler of a port whenever its serial port is readable.
+
+    Registrations are applied by the reactor thread itself, which is woken up through a pipe.
+    The thread is started by the first registration and stops with :meth:`close`. It is a daemon
+    thread blocking until an event, so that it never wakes up while the ports are idle.
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._lock = threading.Lock()
+        #Pending changes: (fileobj, handler or None to unregister, event set once applied)
+        self._changes = []
+        self._closed = False
+        self._thread = None
+
+    @classmethod
+    def shared(cls):
+        """Return the process-wide reactor"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def register(self, fileobj, handler):
+        """Call handler() from the reactor thread whenever fileobj is readable.
+
+        handler may be a :class:`weakref.WeakMethod`, the fileobj is unregistered once it is dead.
+        """
+        self._change(fileobj, handler)
+
+    def unregister(self, fileobj):
+        """Stop waiting on fileobj, returns once the reactor thread does not use it anymore.
+
+        Once the reactor is closed, this does nothing.
+        """
+        self._change(fileobj, None)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        self._wakeup()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _change(self, fileobj, handler):
+        applied = threading.Event()
+        with self._lock:
+            if self._closed:
+                if handler is None:
+                    return  #The reactor thread is stopped or stopping, it does not wait on anything anymore
+                raise RuntimeError("Reactor is closed")
+            self._changes.append((fileobj, handler, applied))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target = self._run, name = 'thorpy-reactor', daemon = True)
+                self._thread.start()
+            thread = self._thread
+        if thread is threading.current_thread():
+            self._apply_changes()
+        else:
+            self._wakeup()
+            applied.wait()
+
+    def _wakeup(self):
+        os.write(self._wakeup_w, b'\x00')
+
+    def _apply_changes(self):
+        with self._lock:
+            changes, self._changes = self._changes, []
+        for fileobj, handler, applied in changes:
+            if handler is None:
+                self._unregister_now(fileobj)
+            else:
+                self._selector.register(fileobj, selectors.EVENT_READ, handler)
+            applied.set()
+
+    def _unregister_now(self, fileobj):
+        try:
+            self._selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def _run(self):
+        self._apply_changes()
+        while True:
+            for key, events in self._selector.select():
+                if key.fileobj == self._wakeup_r:
+                    try:
+                        while os.read(self._wakeup_r, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    self._apply_changes()
+                    continue
+                #Unregistered by the changes applied above, its port may be closed already
+                if self._selector.get_map().get(key.fileobj) is not key:
+                    continue
+
+                handler = key.data
+                if isinstance(handler, weakref.WeakMethod):
+                    handler = handler()
+                try:
+                    if handler is None:
+                        self._unregister_now(key.fileobj)
+                    else:
+                        handler()
+                except Exception:
+                    #A failing port must not stop the others
+                    traceback.print_exc()
+                    self._unregister_now(key.fileobj)
+                #Drop the reference here, not at the next event
+                handler = None
+            with self._lock:
+                if self._closed:
+                    break
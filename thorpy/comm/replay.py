@@ -0,0 +1,122 @@
+import fcntl
+import os
+import termios
+import threading
+import time
+
+from .capture import WireCapture
+
+class ReplayTransport:
+    """Stand-in for :class:`serial.Serial` which plays a :class:`~thorpy.comm.capture.WireCapture` back.
+
+    Pass it to :meth:`Port.create <thorpy.comm.port.Port.create>` instead of the port name. The received
+    bytes of the capture are fed through a pipe, so that the port can wait on :meth:`fileno` as on a
+    serial port, either with the original timing (realtime) or as fast as the port reads them.
+
+    The received bytes which followed a sent frame in the capture are held back until the port sent
+    the corresponding frame, at most wait_timeout seconds. The frames sent by the port are compared
+    with the captured ones, the differences are listed in :attr:`mismatches` as (expected, sent) pairs,
+    where expected or sent is None for a missing or an unexpected frame.
+    Frames the port sends on a timer (ACK_DCSTATUSUPDATE) are neither waited for nor compared.
+    """
+    def __init__(self, path, realtime = False, wait_timeout = 5):
+        from ..message import Message, MGMSG_MOT_ACK_DCSTATUSUPDATE
+        self.path = path
+        self.realtime = realtime
+        self.wait_timeout = wait_timeout
+        self.mismatches = []
+        self.finished = threading.Event()
+        self.is_open = True
+        self._periodic_messages = (MGMSG_MOT_ACK_DCSTATUSUPDATE, )
+        self._records = []
+        for timestamp, direction, data in WireCapture.read(path):
+            if direction == WireCapture.TX:
+                frames = [bytes(msg) for msg in Message.parse_many(data)[0]
+                          if not isinstance(msg, self._periodic_messages)]
+                self._records.extend((timestamp, direction, frame) for frame in frames)
+            else:
+                self._records.append((timestamp, direction, data))
+        #Frames sent by the port, except the periodic ones
+        self._sent = []
+        self._sent_condition = threading.Condition()
+        self._read_fd, self._write_fd = os.pipe()
+        self._thread = threading.Thread(target = self._run, name = 'thorpy-replay', daemon = True)
+        self._thread.start()
+
+    def _run(self):
+        expected_count = 0
+        start_time, start_timestamp = time.monotonic(), None
+        for timestamp, direction, data in self._records:
+            if not self.is_open:
+                return
+            if direction == WireCapture.TX:
+                with self._sent_condition:
+                    if not self._sent_condition.wait_for(lambda: len(self._sent) > expected_count or not self.is_open,
+                                                         self.wait_timeout):
+                        self.mismatches.append((data, None))
+                        continue
+                    if not self.is_open:
+                        return
+                    if self._sent[expected_count] != data:
+                        self.mismatches.append((data, self._sent[expected_count]))
+                expected_count += 1
+                #The controller answers from now on, not from the time of the capture
+                start_time, start_timestamp = time.monotonic(), timestamp
+                continue
+
+            if self.realtime:
+                if start_timestamp is None:
+                    start_time, start_timestamp = time.monotonic(), timestamp
+                delay = (timestamp - start_timestamp) / 1e9 - (time.monotonic() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                os.write(self._write_fd, data)
+            except OSError:
+                return  #Closed
+        with self._sent_condition:
+            self.mismatches.extend((None, frame) for frame in self._sent[expected_count:])
+        self.finished.set()
+
+    #serial.Serial interface used by Port
+    def fileno(self):
+        return self._read_fd
+
+    @property
+    def in_waiting(self):
+        return int.from_bytes(fcntl.ioctl(self._read_fd, termios.FIONREAD, b'\x00' * 4), 'little')
+
+    def read(self, size = 1):
+        return os.read(self._read_fd, size)
+
+    def write(self, data):
+        from ..message import Message
+        frames = [bytes(msg) for msg in Message.parse_many(data)[0] if not isinstance(msg, self._periodic_messages)]
+        if frames:
+            with self._sent_condition:
+                self._sent.extend(frames)
+                self._sent_condition.notify_all()
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass  #The captured bytes must all be delivered
+
+    def reset_output_buffer(self):
+        pass
+
+    def setRTS(self, level = True):
+        pass
+
+    def close(self):
+        if not self.is_open:
+            return
+        with self._sent_condition:
+            self.is_open = False
+            self._sent_condition.notify_all()
+        #Closing the read end first interrupts a write blocked on a full pipe
+        os.close(self._read_fd)
+        self._thread.join()
+        os.close(self._write_fd)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, self.path)
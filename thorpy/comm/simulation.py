@@ -0,0 +1,161 @@
+import weakref
+
+from .emulator import ControllerModel
+from .port import Port
+
+class VirtualClock:
+    """Clock of a simulation, with the interface of the :mod:`time` functions used by the stages.
+
+    Time only advances in :meth:`sleep` (or :meth:`advance`), instantly: the messages which the simulated
+    controllers send in the meantime (status updates, end of moves) are delivered in order, each one
+    at its own virtual time. Several :class:`SimulatedPort` may share a clock.
+    """
+    def __init__(self, start = 0.0):
+        self._now = start
+        self._ports = weakref.WeakSet()
+
+    def time(self):
+        return self._now
+
+    monotonic = time
+
+    def sleep(self, seconds):
+        self.advance(self._now + max(0, seconds))
+
+    def advance(self, deadline = None, until = None):
+        """Deliver the controller messages up to deadline (None for no limit), or until until() is true.
+
+        Returns whether until() became true. Without deadline, time advances until no controller is moving
+        anymore: the periodic status updates never end, so if until() is still false then, nothing else
+        can happen and RuntimeError is raised.
+        """
+        while until is None or not until():
+            if deadline is None and all(candidate._end_of_move_time() is None for candidate in list(self._ports)):
+                if until is None:
+                    return False
+                raise RuntimeError("Waiting without deadline, but only periodic status updates are pending")
+            port, event_time = None, None
+            for candidate in list(self._ports):
+                candidate_time = candidate._next_event_time()
+                if candidate_time is not None and (event_time is None or candidate_time < event_time):
+                    port, event_time = candidate, candidate_time
+            if port is None or (deadline is not None and event_time > deadline):
+                if deadline is not None:
+                    self._now = max(self._now, deadline)
+                return False
+            self._now = max(self._now, event_time)
+            port._process_events(self._now)
+        return True
+
+class SimulatedPort:
+    """Port to a simulated controller (:class:`~thorpy.comm.emulator.ControllerModel`) running on a :class:`VirtualClock`.
+
+    It has the interface of :class:`~thorpy.comm.port.SingleControllerPort` used by
+    :class:`~thorpy.stages.GenericStage`: messages are handled by the controller model as soon as they
+    are sent, and its responses are delivered synchronously. Since the stages wait with the port's
+    :attr:`clock`, homing or waiting for a property takes no real time, and a scan program which sleeps
+    with ``port.clock.sleep`` runs in seconds while ``port.clock.time()`` gives its duration.
+
+    :param model: the controller model, by default a :class:`~thorpy.comm.emulator.ControllerModel`
+        with the given keyword arguments
+    :param clock: the clock, by default a new :class:`VirtualClock`
+    """
+    def __init__(self, model = None, clock = None, **kwargs):
+        from ..message import MGMSG_HW_START_UPDATEMSGS
+        if model is None:
+            model = ControllerModel(**kwargs)
+        self.model = model
+        self.clock = VirtualClock() if clock is None else clock
+        self._serial_number = model.serial_number
+        self._info_message = model.info
+        self._stages = {}
+        #Pending requests: list of [response classes, chan_ident, response]
+        self._requests = []
+        self.clock._ports.add(self)
+        self.send_message(MGMSG_HW_START_UPDATEMSGS(update_rate = 1))
+
+    def send_message(self, msg):
+        msg.source = 0x01
+        msg.dest = 0x50
+        for response in self.model.handle(msg, self.clock.time()):
+            self._deliver(response)
+
+    def send_bytes(self, data):
+        from ..message import Message
+        self.send_message(Message.parse(data))
+
+    def template(self, msg_cls, *varying, **fixed):
+        """Return a pre-encoded message addressed to this controller, see :meth:`thorpy.message.Message.template`"""
+        return msg_cls.template(*varying, source = 0x01, dest = 0x50, **fixed)
+
+    def request(self, msg, timeout = None, response_classes = None, values = ()):
+        """Send a REQ message and return the matching GET message, see :meth:`thorpy.comm.port.Port.request`.
+
+        While waiting for the response, the clock advances (at most by timeout). Without timeout, RuntimeError
+        is raised if the response cannot arrive anymore, see :meth:`VirtualClock.advance`.
+        """
+        from ..message import MessageTemplate
+        response_classes, parameters = Port._request_parameters(msg, response_classes)
+        request = [tuple(response_classes), parameters['chan_ident'] if 'chan_ident' in parameters else None, None]
+        self._requests.append(request)
+        try:
+            if isinstance(msg, MessageTemplate):
+                self.send_bytes(msg.encode(*values))
+            else:
+                self.send_message(msg)
+            deadline = None if timeout is None else self.clock.time() + timeout
+            self.clock.advance(deadline, lambda: request[2] is not None)
+            return request[2]
+        finally:
+            self._requests.remove(request)
+
+    def _deliver(self, msg):
+        for request in self._requests:
+            if request[2] is None and isinstance(msg, request[0]) and \
+               (request[1] is None or 'chan_ident' not in msg or msg['chan_ident'] == request[1]):
+                request[2] = msg
+        self._handle_message(msg)
+
+    def _next_event_time(self):
+        return self.model.next_event_time()
+
+    def _end_of_move_time(self):
+        return self.model.end_of_move_time()
+
+    def _process_events(self, now):
+        msg = self.model.end_of_move(now)
+        if msg is not None:
+            self._deliver(msg)
+        msg, count = self.model.status_updates(now)
+        for i in range(count):
+            self._deliver(msg)
+
+    def _handle_message(self, msg):
+        if 'chan_ident' in msg:
+            stage = self._stages.get(msg['chan_ident'], None)
+            if stage is not None:
+                return stage._handle_message(msg)
+        return False
+
+    @property
+    def serial_number(self):
+        return self._serial_number
+
+    @property
+    def channel_count(self):
+        return self._info_message['nchs']
+
+    def get_stages(self, only_chan_idents = None):
+        from thorpy.stages import stage_name_from_get_hw_info, GenericStage
+        if only_chan_idents is None:
+            only_chan_idents = [0x01]
+
+        assert all(x == 1 for x in only_chan_idents)
+
+        for k in only_chan_idents:
+            if self._stages.get(k, None) is None:
+                self._stages[k] = GenericStage(self, 0x01, stage_name_from_get_hw_info(self._info_message))
+        return dict((k, self._stages[k]) for k in only_chan_idents)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, self._serial_number)
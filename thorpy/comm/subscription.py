@@ -0,0 +1,92 @@
+import collections
+import threading
+import traceback
+
+class Subscription:
+    """Received messages of one class (or all, if None) and one channel (or all, if None).
+
+    With a callback, callback(msg) is called from the receiving thread for every message.
+    Otherwise, messages are kept in a queue of at most maxsize messages, read with :meth:`get`.
+    When the queue is full, the overflow policy decides what happens to a new message:
+
+    - ``'drop_oldest'``: the oldest queued message is dropped
+    - ``'drop_newest'``: the new message is dropped
+    - ``'block'``: the receiving thread waits until there is room, this stalls the port. With a
+      :class:`~thorpy.comm.reactor.Reactor`, the receiving thread is shared: it stalls every port of the reactor.
+
+    Dropped messages are counted in :attr:`dropped`.
+    """
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    BLOCK = 'block'
+
+    def __init__(self, message_class = None, chan_ident = None, callback = None, maxsize = 1000, overflow = DROP_OLDEST):
+        if overflow not in (Subscription.DROP_OLDEST, Subscription.DROP_NEWEST, Subscription.BLOCK):
+            raise ValueError("Unknown overflow policy {0!r}".format(overflow))
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.message_class = message_class
+        self.chan_ident = chan_ident
+        self.callback = callback
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    @property
+    def key(self):
+        return (self.message_class, self.chan_ident)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def get(self, timeout = None):
+        """Return the next message, or None if there is none within timeout (or the subscription is closed)"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._queue or self._closed, timeout):
+                return None
+            if not self._queue:
+                return None
+            msg = self._queue.popleft()
+            if self.overflow == Subscription.BLOCK:
+                self._condition.notify_all()
+            return msg
+
+    def close(self):
+        """Wake up the readers and the receiving thread, further messages are dropped"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _deliver(self, msg):
+        if self.callback is not None:
+            try:
+                self.callback(msg)
+            except Exception:
+                #A failing subscriber must not stop the port
+                traceback.print_exc()
+            return
+
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._queue) >= self.maxsize:
+                if self.overflow == Subscription.DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.overflow == Subscription.DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self._condition.wait_for(lambda: len(self._queue) < self.maxsize or self._closed)
+                    if self._closed:
+                        return
+            self._queue.append(msg)
+            self._condition.notify_all()
+
+    def __repr__(self):
+        return '<{0} {1} channel {2}, {3} queued, {4} dropped>'.format(
+            self.__class__.__name__, 'all messages' if self.message_class is None else self.message_class.__name__,
+            'any' if self.chan_ident is None else self.chan_ident, len(self._queue), self.dropped)
@@ -1,4 +1,4 @@
-from ._base import Message, IncompleteMessageException
+from ._base import Message, IncompleteMessageException, MessageTemplate
 
 from .systemcontrol import *
 from .motorcontrol import *
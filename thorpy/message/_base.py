@@ -1,14 +1,38 @@
+import re
 import struct
+import threading
 from ..helpers import classproperty
 
 
+# Header common to all messages. For short messages, the two bytes read as length are the parameters.
+_header_struct = struct.Struct('<HHBB')
+
+# Valid source and destination addresses: host, rack controller, bays 0 to 9 and generic USB hardware unit
+_addresses = frozenset([0x01, 0x11] + list(range(0x21, 0x2b)) + [0x50])
+
+# Longer data packets are considered corrupt when resynchronizing
+_max_data_length = 512
+
+
+def _is_valid_header(length, dest, source):
+    return (dest & 0x7f) in _addresses and source in _addresses and (dest < 0x80 or length <= _max_data_length)
+
+
 class IncompleteMessageException(Exception):
     """IncompleteMessageException is thrown when a message could not be parsed,
     because some of the bytes are missing."""
     pass
 
 
-class Message:
+class _MessageMeta(type):
+    """Metaclass of :class:`Message`, giving every message class empty __slots__,
+    so that message instances only hold their destination, source and values."""
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        namespace.setdefault('__slots__', ())
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class Message(metaclass=_MessageMeta):
     """Base class for messages.
     
     Subclasses should override:
@@ -16,6 +40,7 @@ class Message:
     - is_long_cmd (bool)
     - parameters (list of tubles like (name, struct encoding))
     """
+    __slots__ = ('_dest', '_source', '_parameter_values')
     
     #This will be overrided by subclasses
     id = 0x0
@@ -24,22 +49,46 @@ class Message:
 
     # class wide caches
     _struct_description = None
+    _parameter_index = {}   # name -> position in parameters
+
+    # Cache of pre-encoded messages, see template()
+    _templates = {}
+
+    # Registry of all message classes, keyed by (id, is_long_cmd). Short and long
+    # variants of a command (e.g. MGMSG_MOT_MOVE_ABSOLUTE_short/_long) share an id.
+    _message_classes = {}
+    _message_classes_by_name = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        key = (cls.id, cls.is_long_cmd)
+        other_cls = Message._message_classes.get(key)
+        # A subclass which does not define its own id specializes its parent and replaces it
+        if other_cls is not None and not issubclass(cls, other_cls):
+            raise ValueError('Multiple classes with id 0x{0:x} defined: {1} and {2}'.format(
+                cls.id, other_cls.__name__, cls.__name__))
+        Message._message_classes[key] = cls
+        Message._message_classes_by_name[cls.__name__] = cls
+
+        # Class wide caches are never shared with the parent class
+        cls._struct_description = None
+        cls._parameter_index = {name: position for position, (name, encoding)
+                                in enumerate(cls.parameters) if name is not None}
+        cls._encode = Message.__dict__['_encode']
+        cls._decode = Message.__dict__['_decode']
 
     def __init__(self, *args, source=0x01, dest=None, **kwargs):
         self.dest, self.source = dest, source
 
-        parameter_values = [None, ] * len(self.parameters)
-
         # Set parameters by position
-        for i, value in enumerate(args):
-            parameter_values[i] = value
+        parameter_values = list(args)
+        parameter_values += [None, ] * (len(self.parameters) - len(parameter_values))
 
         # Set parameter by name
-        parameter_mapping = {name: position for position, (name, encoding)
-                             in enumerate(self.parameters)}
+        parameter_index = self._parameter_index
         for name, value in kwargs.items():
             try:
-                position = parameter_mapping[name]
+                position = parameter_index[name]
             except KeyError:
                 raise KeyError('{0} not a valid parameter. Must be one of {1}'.format(name, self.parameter_names))
 
@@ -48,10 +97,13 @@ class Message:
             parameter_values[position] = value
 
         # Check that all parameters of the message are set. A message may not miss any parameters on creation.
-        for position, ((name, encoding), value) in enumerate(zip(self.parameters, parameter_values)):
-            if name is not None and value is None:
-                raise ValueError('Parameter {0} "{1}" ({2}) was not set.'.format(position, name, encoding))
-        self._parameter_values = parameter_values
+        if len(parameter_values) > len(self.parameters):
+            raise ValueError('Too many parameters, {0} has {1}.'.format(self.name, len(self.parameters)))
+        for name, position in parameter_index.items():
+            if parameter_values[position] is None:
+                raise ValueError('Parameter {0} "{1}" ({2}) was not set.'.format(
+                    position, name, self.parameters[position][1]))
+        self._parameter_values = tuple(parameter_values)
 
     @property
     def dest(self):
@@ -90,9 +142,18 @@ class Message:
         split_name = cls.__name__.split('_')
         return split_name[2] in ('REQ', 'SET', 'GET')
 
+    @classproperty
+    def response_class(cls):
+        """For a REQ message, the matching GET message class (None for other messages)"""
+        split_name = cls.__name__.split('_')
+        if len(split_name) < 3 or split_name[2] != 'REQ':
+            return None
+        split_name[2] = 'GET'
+        return Message._message_classes_by_name.get('_'.join(split_name))
+
     @classproperty
     def parameter_names(cls):
-        return [name for name, encoding in cls.parameters if name is not None]
+        return list(cls._parameter_index)
 
     @classproperty
     def struct_description(cls):
@@ -127,86 +188,266 @@ class Message:
         if isinstance(k, int):
             return self._parameter_values[k]
         else:
-            # FIXME: This is a bit inefficient since we create dictioneries on the fly.
-            #        However, I doubt this will ever become a bottle neck.
-            return dict(self.parameter_items)[k]
+            return self._parameter_values[self._parameter_index[k]]
         
     def __contains__(self, k):
-        return k in self.parameter_names
+        return k in self._parameter_index
 
     @classmethod
-    def get_message_class_by_id(cls, message_id):
-        message_classes = list(filter(lambda x: x.id == message_id, Message.__subclasses__()))
+    def get_message_class_by_id(cls, message_id, is_long_cmd=None):
+        if is_long_cmd is not None:
+            try:
+                return Message._message_classes[message_id, is_long_cmd]
+            except KeyError:
+                raise KeyError('Unknown message id {0}'.format(message_id)) from None
+
+        message_classes = [Message._message_classes[message_id, long_cmd] for long_cmd in (False, True)
+                           if (message_id, long_cmd) in Message._message_classes]
         assert len(message_classes) < 2, 'Multiple classes with id {0} defined'.format(message_id)
         if len(message_classes) < 1:
             raise KeyError('Unknown message id {0}'.format(message_id))
         return message_classes[0]
 
     @classmethod
-    def parse(cls, buffer):
-        base_package = struct.Struct('<HHBB')
-        base_package_length = base_package.size
+    def _build_codec(cls):
+        """Generate the encode and decode functions of this class.
+
+        The functions are generated once from :attr:`parameters` and :attr:`struct_description`,
+        so that they pack and unpack the values positionally without building any dictionaries.
+        """
+        fields, msg_struct = cls.struct_description
+        values = ['v{0}'.format(i) for i in range(len(cls.parameters))]
+        # Names of the parameter values in the struct, in the order of the struct
+        params = iter(values)
+        struct_values = [field if field in ('message_id', 'length', 'dest', 'source') else next(params)
+                         for field in fields]
+
+        decode_src = [
+            'def decode(buffer, offset=0):',
+            '    {0}, = unpack_from(buffer, offset)'.format(', '.join(struct_values)),
+        ]
+        if cls.is_long_cmd:
+            decode_src += [
+                '    if length != {0}:'.format(msg_struct.size - 6),
+                "        raise ValueError('Length {{0}} does not match {0}'.format(length))".format(cls.__name__),
+            ]
+        decode_src += [
+            '    self = new(cls)',
+            '    self._dest = dest{0}'.format(' & 0x7f' if cls.is_long_cmd else ''),
+            '    self._source = source',
+            '    self._parameter_values = ({0},)'.format(', '.join(
+                'None' if name is None else value for (name, encoding), value in zip(cls.parameters, values))),
+            '    return self',
+        ]
+
+        encoded_values = {'message_id': str(cls.id), 'length': str(msg_struct.size - 6),
+                          'dest': 'dest | 0x80' if cls.is_long_cmd else 'dest', 'source': 'source'}
+        for (name, encoding), value in zip(cls.parameters, values):
+            if name is None:
+                encoded_values[value] = '0' if encoding[-1] != 's' else "b''"
+            elif encoding[-1] == 's':
+                encoded_values[value] = "{0}.encode('ascii') if {0}.__class__ is str else {0}".format(value)
+            else:
+                encoded_values[value] = value
+        encode_src = [
+            'def encode(self):',
+            '    dest, source = self._dest, self._source',
+            '    if dest is None:',
+            "        raise RuntimeError('Cannot convert message without destination to byte representation')",
+            '    if source is None:',
+            "        raise RuntimeError('Cannot convert message without source to byte representation')",
+            '    {0}, = self._parameter_values'.format(', '.join(values)),
+            '    return pack({0})'.format(', '.join(encoded_values[value] for value in struct_values)),
+        ]
+
+        namespace = {'cls': cls, 'new': object.__new__, 'pack': msg_struct.pack, 'unpack_from': msg_struct.unpack_from}
+        exec('\n'.join(decode_src + encode_src), namespace)
+        cls._decode = staticmethod(namespace['decode'])
+        cls._encode = namespace['encode']
+
+    # Placeholders, replaced by the generated functions on first use
+    def _encode(self):
+        self._build_codec()
+        return self._encode()
+
+    @classmethod
+    def _decode(cls, buffer, offset=0):
+        cls._build_codec()
+        return cls._decode(buffer, offset)
+
+    @classmethod
+    def parse(cls, buffer, offset=0):
+        """Parse the message starting at offset in buffer.
+
+        The message is unpacked in place, buffer may be any object supporting the buffer protocol
+        (bytes, bytearray, memoryview). Bytes following the message are ignored.
+        """
+        available = len(buffer) - offset
 
         # Messages less than 6 bytes cannot be complete according to the spec, ignore them
-        if len(buffer) < base_package_length:
+        if available < _header_struct.size:
             raise IncompleteMessageException()
 
         # Assuming a long message, get its id and length
-        message_id, length, dest, source = base_package.unpack(buffer[:base_package_length])
+        message_id, length, dest, source = _header_struct.unpack_from(buffer, offset)
         long_message = (dest & 0x80) == 0x80    # Is it really a long message?
 
         # In case of a long message, we might not have all bytes yet
-        if len(buffer) < base_package_length + (length if long_message else 0):
+        if available < _header_struct.size + (length if long_message else 0):
             raise IncompleteMessageException()
 
-        msg_cls = Message.get_message_class_by_id(message_id)
-        # TODO: Add checks if long message is really a long message
-        fields, msg_struct = msg_cls.struct_description
-        descr = dict(zip(fields, msg_struct.unpack(buffer)))
-
-        if msg_cls.is_long_cmd:
-            assert descr['dest'] & 0x80, 'Long message expected, but message binary does not mark it as long.'
-            descr['dest'] &= 0x7f
+        try:
+            msg_cls = Message._message_classes[message_id, long_message]
+        except KeyError:
+            raise KeyError('Unknown message id {0}'.format(message_id)) from None
 
-            assert descr['length'] == len(buffer) - 6
-            del descr['length']
+        if long_message and length != msg_cls.binary_length - 6:
+            raise ValueError('Length {0} does not match {1}'.format(length, msg_cls.__name__))
 
-        assert descr['message_id'] == msg_cls.id
-        del descr['message_id']
+        return msg_cls._decode(buffer, offset)
 
-        if None in descr:
-            del descr[None]
-
-        return msg_cls(**descr)
+    @classmethod
+    def parse_many(cls, buffer, offset=0, on_skip=None):
+        """Parse all the complete messages in buffer, starting at offset.
+
+        Unlike :meth:`parse`, an incomplete message at the end of the buffer is not an error.
+
+        By default, an unknown message raises a KeyError. If on_skip is given, unknown messages are
+        skipped using the length from their header, and bytes which do not start with a valid header
+        (or a known long message with a length which does not match its class) are skipped until the
+        stream is synchronized again. on_skip(offset, length, is_frame) is called
+        for every skipped message (is_frame is True) or run of corrupt bytes (is_frame is False).
+
+        :return: the list of messages and the offset of the first byte which was not consumed.
+        """
+        messages = []
+        available = len(buffer) - offset
+        message_classes = Message._message_classes
+        unpack_header = _header_struct.unpack_from
+        while available >= 6:
+            message_id, length, dest, source = unpack_header(buffer, offset)
+            if on_skip is not None and not _is_valid_header(length, dest, source):
+                start = offset
+                offset, available = offset + 1, available - 1
+                while available >= 6 and not _is_valid_header(*unpack_header(buffer, offset)[1:]):
+                    offset, available = offset + 1, available - 1
+                on_skip(start, offset - start, False)
+                continue
+
+            long_message = (dest & 0x80) == 0x80
+            msg_cls = message_classes.get((message_id, long_message))
+            if long_message and msg_cls is not None and length != msg_cls.binary_length - 6:
+                # Not the start of this message, e.g. corrupt bytes which look like a header
+                if on_skip is None:
+                    raise ValueError('Length {0} does not match {1}'.format(length, msg_cls.__name__))
+                on_skip(offset, 1, False)
+                offset, available = offset + 1, available - 1
+                continue
+
+            size = 6 + length if long_message else 6
+            if available < size:
+                break
 
-    def __bytes__(self):
-        fields, msg_struct = self.struct_description
+            try:
+                if msg_cls is None:
+                    raise KeyError('Unknown message id {0}'.format(message_id))
+                messages.append(msg_cls._decode(buffer, offset))
+            except (KeyError, ValueError, struct.error):
+                if on_skip is None:
+                    raise
+                on_skip(offset, size, True)
+            offset += size
+            available -= size
+        return messages, offset
 
-        if self.dest is None:
-            raise RuntimeError('Cannot convert message without destination '
-                               'to byte representation')
+    @classmethod
+    def iter_parse(cls, chunks, on_skip=None):
+        """Parse a stream of bytes, given as an iterable of chunks, and yield the messages as they complete.
+
+        Bytes of an incomplete message at the end of the stream are ignored. Unknown messages and corrupt
+        bytes are handled as in :meth:`parse_many`, the offsets given to on_skip are relative to the start
+        of the stream.
+        """
+        buffer = bytearray()
+        base = 0
+        if on_skip is not None:
+            skip = on_skip
+            on_skip = lambda offset, length, is_frame: skip(base + offset, length, is_frame)
+        for chunk in chunks:
+            buffer += chunk
+            messages, offset = cls.parse_many(buffer, 0, on_skip)
+            base += offset
+            del buffer[:offset]
+            yield from messages
 
-        if self.source is None:
-            raise RuntimeError('Cannot convert message without source to '
-                               'to byte representation')
+    @classmethod
+    def template(cls, *varying, source=0x01, dest=None, **fixed):
+        """Return a pre-encoded :class:`MessageTemplate` of this message.
 
-        descr = dict(self.parameter_items)
-        descr['message_id'] = self.id
-        descr['length'] = self.binary_length - 6
-        descr['source'] = self.source
-        descr['dest'] = self.dest | (0x80 if self.is_long_cmd else 0)
-        descr[None] = 0
+        Templates are cached, they are created only once for a given class, source, destination,
+        varying parameter names and fixed parameter values.
 
-        values = map(lambda x: descr[x], fields)
+        :param varying: names of the parameters given to :meth:`MessageTemplate.encode`
+        :param fixed: values of the other parameters
+        """
+        key = (cls, varying, source, dest, tuple(sorted(fixed.items())))
+        try:
+            return Message._templates[key]
+        except KeyError:
+            return Message._templates.setdefault(key, MessageTemplate(cls, varying, source, dest, fixed))
 
-        type_mapping = {
-            str: lambda x: x.encode('ascii')
-        }
-        encoded_values = map(lambda x: type_mapping.get(type(x), type(x))(x), values)
-        return msg_struct.pack(*encoded_values)
+    def __bytes__(self):
+        return self._encode()
 
     def __repr__(self):
         return "<%s>(dest=0x%x, src=0x%x, %s)" % (self.__class__.__name__,
                                                 self.dest, self.source,
                                                 ', '.join('{0}={1}'.format(name, repr(value)) for name, value in
                                                           self.parameter_items))
+
+
+class MessageTemplate:
+    """Pre-encoded message, where only the varying parameters are patched in on each encoding.
+
+    Use :meth:`Message.template` to get a cached instance.
+    """
+    __slots__ = ('message_class', 'varying', 'fixed', '_buffer', '_bytes', '_fields', '_lock')
+
+    def __init__(self, message_class, varying, source, dest, fixed):
+        self.message_class = message_class
+        self.varying = tuple(varying)
+        self.fixed = dict(fixed)
+
+        parameter_values = dict(fixed)
+        for name in self.varying:
+            if name in parameter_values:
+                raise ValueError('Parameter "{0}" cannot be both fixed and varying.'.format(name))
+            encoding = message_class.parameters[message_class._parameter_index[name]][1]
+            parameter_values[name] = b'' if encoding[-1] == 's' else 0
+        self._bytes = bytes(message_class(source=source, dest=dest, **parameter_values))
+        self._buffer = bytearray(self._bytes)
+
+        # Struct and offset of each varying parameter in the encoded message
+        fields, msg_struct = message_class.struct_description
+        encodings = re.findall(r'\d*[a-zA-Z?]', msg_struct.format[1:])
+        self._fields = []
+        for name in self.varying:
+            position = fields.index(name)
+            self._fields.append((struct.Struct('<' + encodings[position]),
+                                 struct.calcsize('<' + ''.join(encodings[:position]))))
+        self._lock = threading.Lock()
+
+    def encode(self, *values):
+        """Return the encoded message, with the varying parameters set to values."""
+        if not values:
+            return self._bytes
+        with self._lock:
+            for (field_struct, offset), value in zip(self._fields, values):
+                field_struct.pack_into(self._buffer, offset, value)
+            return bytes(self._buffer)
+
+    def __bytes__(self):
+        return self._bytes
+
+    def __repr__(self):
+        return '<{0} template>({1})'.format(self.message_class.__name__, ', '.join(self.varying))
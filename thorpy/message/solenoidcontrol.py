@@ -19,7 +19,7 @@ class MGMSG_MOT_GET_SOL_OPERATINGMODE(Message):
 
 
 class MGMSG_MOT_GET_SOL_STATE(Message):
-    id = 0x4c8
+    id = 0x4cd
     parameters = [('chan_ident', 'B'), ('state', 'B')]
 
 
@@ -39,7 +39,7 @@ class MGMSG_MOT_REQ_SOL_OPERATINGMODE(Message):
 
 
 class MGMSG_MOT_REQ_SOL_STATE(Message):
-    id = 0x4c7
+    id = 0x4cc
     parameters = [('chan_ident', 'B'), (None, 'B')]
 
 
@@ -60,5 +60,5 @@ class MGMSG_MOT_SET_SOL_OPERATINGMODE(Message):
 
 
 class MGMSG_MOT_SET_SOL_STATE(Message):
-    id = 0x4c6
+    id = 0x4cb
     parameters = [('chan_ident', 'B'), ('state', 'B')]
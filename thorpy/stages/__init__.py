@@ -1,7 +1,5 @@
 from thorpy.message import *
-import weakref
-import time
-import pkgutil
+import collections
 
 def _print_stage_detection_improve_message(m):
     import sys
@@ -89,84 +87,95 @@ def stage_name_from_get_hw_info(m):
         _print_stage_detection_improve_message(m)
         return None
 
+#Status bits of STATUSUPDATE, DCSTATUSUPDATE and MOVE_COMPLETED
+_status_flags = [
+    ('forward_hardware_limit_switch_active', 0x00000001),
+    ('reverse_hardware_limit_switch_active', 0x00000002),
+    ('in_motion_forward', 0x00000010),
+    ('in_motion_reverse', 0x00000020),
+    ('in_motion_jogging_forward', 0x00000040),
+    ('in_motion_jogging_reverse', 0x00000080),
+    ('in_motion_homing', 0x00000200),
+    ('homed', 0x00000400),
+    ('tracking', 0x00001000),
+    ('settled', 0x00002000),
+    ('motion_error', 0x00004000),
+    ('motor_current_limit_reached', 0x01000000),
+    ('channel_enabled', 0x80000000),
+]
+
+_StageStatus = collections.namedtuple('StageStatus', ['position', 'velocity', 'status_bits', 'timestamp'] + [x[0] for x in _status_flags])
+
+class StageStatus(_StageStatus):
+    """Snapshot of the state of a stage, decoded from a single status message, see :meth:`GenericStage.status`.
+
+    position is in the units of the stage, velocity in units/s (None if the message did not carry it,
+    e.g. STATUSUPDATE or MOVE_COMPLETED), timestamp is the time at which the message was received, and
+    every status bit is a boolean field, e.g. homed.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_message(cls, msg, profile, timestamp):
+        status_bits = msg['status_bits']
+        velocity = profile.status_velocity(msg['velocity']) if 'velocity' in msg else None
+        return cls(profile.counts_to_position(msg['position']), velocity, status_bits, timestamp,
+                   *[(status_bits & bit) != 0 for name, bit in _status_flags])
+
+    @property
+    def in_motion(self):
+        return (self.status_bits & 0x000002f0) != 0
+
 class GenericStage:
+    #Property -> (cached state, request message attribute), see read()
+    _property_states = dict(
+        [('position', ('_state_position', '_msg_req_dcstatusupdate')),
+         ('velocity', ('_state_velocity', '_msg_req_dcstatusupdate'))] +
+        [('status_' + name, ('_state_status_bits', '_msg_req_dcstatusupdate')) for name, bit in _status_flags] +
+        [(name, ('_state_' + name, '_msg_req_velparams')) for name in ('min_velocity', 'max_velocity', 'acceleration')] +
+        [(name, ('_state_' + name, '_msg_req_homeparams'))
+         for name in ('home_velocity', 'home_direction', 'home_limit_switch', 'home_offset_distance')])
+    #Property -> StageProfile method converting its cached state, status bit mask, or None if it is not converted
+    _property_conversions = dict(
+        [('position', 'counts_to_position'), ('velocity', 'status_velocity')] +
+        [('status_' + name, bit) for name, bit in _status_flags] +
+        [(name, 'apt_to_velocity') for name in ('min_velocity', 'max_velocity', 'home_velocity')] +
+        [('acceleration', 'apt_to_acceleration'), ('home_direction', None), ('home_limit_switch', None),
+         ('home_offset_distance', 'counts_to_position')])
+    
     def __init__(self, port, chan_ident, ini_section):
-        import os, configparser
+        from .database import stage_database, stage_profile
         self._port = port
         self._chan_ident = chan_ident
-        self._config = configparser.ConfigParser()
-        self._config.read_string(pkgutil.get_data('thorpy.stages','MG17APTServer.ini').decode('ascii'))
-        
+        #time module, or the virtual clock of a simulation
+        self._clock = port.clock
         self._name = ini_section
+        #Immutable, shared by all the stages of this type
+        self._conf = stage_database()[ini_section]
+        self._profile = stage_profile(ini_section)
         
-        self._conf_stage_id = self._config.getint(ini_section, 'Stage ID')
-        self._conf_axis_id = self._config.getint(ini_section, 'Axis ID')
-        self._conf_units = self._config.getint(ini_section, 'Units')
-        self._conf_pitch = self._config.getfloat(ini_section, 'Pitch')
-        self._conf_dir_sense = self._config.getint(ini_section, 'Dir Sense')
-        self._conf_min_pos = self._config.getfloat(ini_section, 'Min Pos')
-        self._conf_max_pos = self._config.getfloat(ini_section, 'Max Pos')
-        self._conf_def_min_vel = self._config.getfloat(ini_section, 'Def Min Vel')
-        self._conf_def_accn = self._config.getfloat(ini_section, 'Def Accn')
-        self._conf_def_max_vel = self._config.getfloat(ini_section, 'Def Max Vel')
-        self._conf_max_accn = self._config.getfloat(ini_section, 'Max Accn')
-        self._conf_def_accn = self._config.getfloat(ini_section, 'Def Accn')
-        self._conf_max_vel = self._config.getfloat(ini_section, 'Max Vel')
-        self._conf_backlash_dist = self._config.getfloat(ini_section, 'Backlash Dist')
-        self._conf_move_factor = self._config.getint(ini_section, 'Move Factor')
-        self._conf_rest_factor = self._config.getint(ini_section, 'Rest Factor')
-        self._conf_cw_hard_limit = self._config.getint(ini_section, 'CW Hard Limit')
-        self._conf_ccw_hard_limit = self._config.getint(ini_section, 'CCW Hard Limit')
-        self._conf_cw_soft_limit = self._config.getfloat(ini_section, 'CW Soft Limit')
-        self._conf_ccw_soft_limit = self._config.getfloat(ini_section, 'CCW Soft Limit')        
-        self._conf_soft_limit_mode = self._config.getint(ini_section, 'Soft Limit Mode')
-        self._conf_home_dir = self._config.getint(ini_section, 'Home Dir')
-        self._conf_home_limit_switch = self._config.getint(ini_section, 'Home Limit Switch')
-        self._conf_home_vel = self._config.getfloat(ini_section, 'Home Vel')
-        self._conf_home_zero_offset = self._config.getfloat(ini_section, 'Home Zero Offset')
-        self._conf_jog_mode = self._config.getint(ini_section, 'Jog Mode')
-        self._conf_jog_step_size = self._config.getfloat(ini_section, 'Jog Step Size')
-        self._conf_jog_min_vel = self._config.getfloat(ini_section, 'Jog Min Vel')
-        self._conf_jog_accn = self._config.getfloat(ini_section, 'Jog Accn')
-        self._conf_jog_max_vel = self._config.getfloat(ini_section, 'Jog Max Vel')
-        self._conf_jog_stop_mode = self._config.getint(ini_section, 'Jog Stop Mode')
-        self._conf_steps_per_rev = self._config.getint(ini_section, 'Steps Per Rev')
-        self._conf_gearbox_ratio = self._config.getint(ini_section, 'Gearbox Ratio')
-        self._conf_dc_servo = self._config.getboolean(ini_section, 'DC Servo', fallback = False)
+        #Pre-encoded messages
+        self._msg_ack_dcstatusupdate = port.template(MGMSG_MOT_ACK_DCSTATUSUPDATE)
+        self._msg_req_dcstatusupdate = port.template(MGMSG_MOT_REQ_DCSTATUSUPDATE, chan_ident = self._chan_ident)
+        self._msg_req_velparams = port.template(MGMSG_MOT_REQ_VELPARAMS, chan_ident = self._chan_ident)
+        self._msg_req_homeparams = port.template(MGMSG_MOT_REQ_HOMEPARAMS, chan_ident = self._chan_ident)
+        self._msg_move_home = port.template(MGMSG_MOT_MOVE_HOME, chan_ident = self._chan_ident)
+        self._msg_move_absolute = port.template(MGMSG_MOT_MOVE_ABSOLUTE_long, 'absolute_distance', chan_ident = self._chan_ident)
+        #Some controllers answer the status request with the non DC status update
+        self._response_classes = {
+            self._msg_req_dcstatusupdate: (MGMSG_MOT_GET_DCSTATUSUPDATE, MGMSG_MOT_GET_STATUSUPDATE),
+        }
         
-        if self._conf_dc_servo:
-            self._conf_dc_prop = self._config.getint(ini_section, 'DC Prop')
-            self._conf_dc_int = self._config.getint(ini_section, 'DC Int')
-            self._conf_dc_diff = self._config.getint(ini_section, 'DC Diff')
-            self._conf_dc_intlim = self._config.getint(ini_section, 'DC IntLim')
-        
-        self._conf_fp_controls = self._config.getboolean(ini_section, 'FP Controls', fallback = False)
-        if self._conf_fp_controls:
-            self._conf_pot_zero_wnd = self._config.getint(ini_section, 'Pot Zero Wnd')
-            self._conf_pot_vel_1 = self._config.getfloat(ini_section, 'Pot Vel 1')
-            self._conf_pot_wnd_1 = self._config.getint(ini_section, 'Pot Wnd 1')
-            self._conf_pot_vel_2 = self._config.getfloat(ini_section, 'Pot Vel 2')
-            self._conf_pot_wnd_2 = self._config.getint(ini_section, 'Pot Wnd 2')
-            self._conf_pot_vel_3 = self._config.getfloat(ini_section, 'Pot Vel 3')
-            self._conf_pot_wnd_3 = self._config.getint(ini_section, 'Pot Wnd 3')
-            self._conf_pot_vel_4 = self._config.getfloat(ini_section, 'Pot Vel 4')
-            self._conf_button_mode = self._config.getint(ini_section, 'Button Mode')
-            self._conf_button_pos_1 = self._config.getfloat(ini_section, 'Button Pos 1')
-            self._conf_button_pos_2 = self._config.getfloat(ini_section, 'Button Pos 2')
-            
-        self._conf_js_params = self._config.getboolean(ini_section, 'JS Params', fallback = False)
-        if self._conf_js_params:
-            self._conf_js_gearlow_maxvel = self._config.getfloat(ini_section, 'JS GearLow MaxVel')
-            self._conf_js_gearlow_accn = self._config.getfloat(ini_section, 'JS GearLow Accn')
-            self._conf_js_dir_sense = self._config.getfloat(ini_section, 'JS Dir Sense')
-            
-        self._last_ack_sent = time.time()
+        self._last_ack_sent = self._clock.time()
         
         self._port.send_message(MGMSG_MOD_SET_CHANENABLESTATE(chan_ident = self._chan_ident, chan_enable_state = 0x01))
         
         print("Constructed: {0!r}".format(self))
         
-        #STATUSUPDATE
+        #Receive time of every cached state
+        self._state_timestamps = {}
+        #STATUSUPDATE, and (message, receive time) of the last one
+        self._state_status = None
         self._state_position = None
         self._state_velocity = None
         self._state_status_bits = None
@@ -185,18 +194,22 @@ class GenericStage:
         print("Destructed: {0!r}".format(self))
         
     def _handle_message(self, msg):
-        if self._last_ack_sent < time.time() - 0.5:
-            self._port.send_message(MGMSG_MOT_ACK_DCSTATUSUPDATE())
-            self._last_ack_sent = time.time()
+        if self._last_ack_sent < self._clock.time() - 0.5:
+            self._port.send_bytes(self._msg_ack_dcstatusupdate.encode())
+            self._last_ack_sent = self._clock.time()
             
         if isinstance(msg, MGMSG_MOT_GET_DCSTATUSUPDATE) or \
            isinstance(msg, MGMSG_MOT_GET_STATUSUPDATE) or \
            isinstance(msg, MGMSG_MOT_MOVE_COMPLETED):
             
+            now = self._clock.time()
+            self._state_status = (msg, now)
             self._state_position = msg['position']
             if isinstance(msg, MGMSG_MOT_GET_DCSTATUSUPDATE):
                 self._state_velocity = msg['velocity']
+                self._state_timestamps['_state_velocity'] = now
             self._state_status_bits = msg['status_bits']
+            self._state_timestamps.update(_state_status = now, _state_position = now, _state_status_bits = now)
             return True
         
         if isinstance(msg, MGMSG_MOT_MOVE_HOMED):
@@ -206,6 +219,8 @@ class GenericStage:
             self._state_min_velocity = msg['min_velocity']
             self._state_max_velocity = msg['max_velocity']
             self._state_acceleration = msg['acceleration']
+            now = self._clock.time()
+            self._state_timestamps.update(_state_min_velocity = now, _state_max_velocity = now, _state_acceleration = now)
             return True
         
         if isinstance(msg, MGMSG_MOT_GET_HOMEPARAMS):
@@ -213,6 +228,9 @@ class GenericStage:
             self._state_home_limit_switch = msg['limit_switch']
             self._state_home_velocity = msg['home_velocity']
             self._state_home_offset_distance = msg['offset_distance']
+            now = self._clock.time()
+            self._state_timestamps.update(_state_home_direction = now, _state_home_limit_switch = now,
+                                          _state_home_velocity = now, _state_home_offset_distance = now)
             return True
             
         
@@ -220,103 +238,149 @@ class GenericStage:
     
     #STATUSUPDATE
     
+    def status(self, timeout = 3, max_age = None):
+        """Return a :class:`StageStatus` of the last status message.
+        
+        A status is requested if none was received yet, or if the last one is older than max_age seconds
+        (0 forces a new one). Raises TimeoutError if no status young enough is received within timeout.
+        """
+        if not self._wait_for_properties(('_state_status', ), timeout = timeout, message = self._msg_req_dcstatusupdate, max_age = max_age):
+            raise TimeoutError("No status from {0!r} within {1}s".format(self, timeout))
+        return self._status_snapshot()
+    
+    def read(self, name, max_age = None, timeout = 3):
+        """Return the value of the property name, refreshed from the controller if older than max_age seconds.
+        
+        With max_age None, this is the same as reading the property: the cached value is returned
+        as long as there is one. With max_age 0, the value is requested unless it was received at the
+        current time of the port's clock (which only happens with a virtual clock).
+        Raises TimeoutError if no value young enough is received within timeout.
+        """
+        state, message = self._property_states[name]
+        if not self._wait_for_properties((state, ), timeout = timeout, message = getattr(self, message), max_age = max_age):
+            raise TimeoutError("No {0} from {1!r} within {2}s".format(name, self, timeout))
+        return self._value(name)
+    
+    def age(self, name):
+        """Return the time in seconds since the value of the property name was received, or None"""
+        timestamp = self._state_timestamps.get(self._property_states[name][0], None)
+        return None if timestamp is None else self._clock.time() - timestamp
+    
+    def _value(self, name):
+        """Return the value of the property name, converted from its cached state without waiting"""
+        state = getattr(self, self._property_states[name][0])
+        conversion = self._property_conversions[name]
+        if conversion is None:
+            return state
+        if isinstance(conversion, int):
+            return (state & conversion) != 0
+        return getattr(self._profile, conversion)(state)
+    
+    def _status_snapshot(self):
+        #A single reference, the worker thread replaces it as a whole
+        state_status = self._state_status
+        if state_status is None:
+            raise TimeoutError("No status from {0!r}".format(self))
+        msg, timestamp = state_status
+        return StageStatus.from_message(msg, self._profile, timestamp)
+    
     @property
     def position(self):
-        self._wait_for_properties(('_state_position', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return self._state_position / self._EncCnt
+        self._wait_for_properties(('_state_position', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('position')
 
     @position.setter
     def position(self, new_value):
         assert type(new_value) in (float, int)
-        absolute_distance = int(new_value * self._EncCnt)
-        self._port.send_message(MGMSG_MOT_MOVE_ABSOLUTE_long(chan_ident = self._chan_ident, absolute_distance = absolute_distance))
+        absolute_distance = self._profile.position_to_counts(new_value)
+        self._port.send_bytes(self._msg_move_absolute.encode(absolute_distance))
 
     @property
     def velocity(self):
-        self._wait_for_properties(('_state_velocity', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return self._state_velocity / (self._EncCnt * self._T)  #Dropped the 65536 factor, which resulted in false results
+        self._wait_for_properties(('_state_velocity', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('velocity')
 
     @property
     def status_forward_hardware_limit_switch_active(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x00000001) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_forward_hardware_limit_switch_active')
 
     @property
     def status_reverse_hardware_limit_switch_active(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x00000002) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_reverse_hardware_limit_switch_active')
 
     @property
     def status_in_motion_forward(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x00000010) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_in_motion_forward')
 
     @property
     def status_in_motion_reverse(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x00000020) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_in_motion_reverse')
 
     @property
     def status_in_motion_jogging_forward(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x00000040) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_in_motion_jogging_forward')
 
     @property
     def status_in_motion_jogging_reverse(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x00000080) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_in_motion_jogging_reverse')
 
     @property
     def status_in_motion_homing(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x00000200) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_in_motion_homing')
 
     @property
     def status_homed(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x00000400) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_homed')
 
     @property
     def status_tracking(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x00001000) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_tracking')
 
     @property
     def status_settled(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x00002000) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_settled')
 
     @property
     def status_motion_error(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x00004000) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_motion_error')
 
     @property
     def status_motor_current_limit_reached(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x01000000) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_motor_current_limit_reached')
 
     @property
     def status_channel_enabled(self):
-        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
-        return (self._state_status_bits & 0x80000000) != 0
+        self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = self._msg_req_dcstatusupdate)
+        return self._value('status_channel_enabled')
     
     #VELPARAMS
     
     @property
     def min_velocity(self):
-        self._wait_for_properties(('_state_min_velocity', ), timeout = 3, message = MGMSG_MOT_REQ_VELPARAMS(chan_ident = self._chan_ident))
-        return self._state_min_velocity / (self._EncCnt * self._T * 65536)
+        self._wait_for_properties(('_state_min_velocity', ), timeout = 3, message = self._msg_req_velparams)
+        return self._value('min_velocity')
     
     @property
     def max_velocity(self):
-        self._wait_for_properties(('_state_max_velocity', ), timeout = 3, message = MGMSG_MOT_REQ_VELPARAMS(chan_ident = self._chan_ident))
-        return self._state_max_velocity / (self._EncCnt * self._T * 65536)
+        self._wait_for_properties(('_state_max_velocity', ), timeout = 3, message = self._msg_req_velparams)
+        return self._value('max_velocity')
     
     @property
     def acceleration(self):
-        self._wait_for_properties(('_state_acceleration', ), timeout = 3, message = MGMSG_MOT_REQ_VELPARAMS(chan_ident = self._chan_ident))
-        return self._state_acceleration / (self._EncCnt * (self._T ** 2) * 65536)
+        self._wait_for_properties(('_state_acceleration', ), timeout = 3, message = self._msg_req_velparams)
+        return self._value('acceleration')
     
     @min_velocity.setter
     def min_velocity(self, new_value):
@@ -333,9 +397,9 @@ class GenericStage:
     def _set_velparams(self, min_velocity, max_velocity, acceleration):
         msg = MGMSG_MOT_SET_VELPARAMS(
             chan_ident = self._chan_ident,
-            min_velocity = int(min_velocity *(self._EncCnt * self._T * 65536)),
-            max_velocity = int(max_velocity *(self._EncCnt * self._T * 65536)),
-            acceleration = int(acceleration *(self._EncCnt * (self._T ** 2) * 65536)),
+            min_velocity = self._profile.velocity_to_apt(min_velocity),
+            max_velocity = self._profile.velocity_to_apt(max_velocity),
+            acceleration = self._profile.acceleration_to_apt(acceleration),
         )
         self._port.send_message(msg)
         #Invalidate current values
@@ -348,8 +412,8 @@ class GenericStage:
     
     @property
     def home_velocity(self):
-        self._wait_for_properties(('_state_home_velocity', ), timeout = 3, message = MGMSG_MOT_REQ_HOMEPARAMS(chan_ident = self._chan_ident))
-        return self._state_home_velocity / (self._EncCnt * self._T * 65536)
+        self._wait_for_properties(('_state_home_velocity', ), timeout = 3, message = self._msg_req_homeparams)
+        return self._value('home_velocity')
     
     @home_velocity.setter
     def home_velocity(self, new_value):
@@ -357,26 +421,26 @@ class GenericStage:
 
     @property
     def home_direction(self):
-        self._wait_for_properties(('_state_home_direction', ), timeout = 3, message = MGMSG_MOT_REQ_HOMEPARAMS(chan_ident = self._chan_ident))
-        return self._state_home_direction
+        self._wait_for_properties(('_state_home_direction', ), timeout = 3, message = self._msg_req_homeparams)
+        return self._value('home_direction')
     
     @property
     def home_limit_switch(self):
-        self._wait_for_properties(('_state_home_limit_switch', ), timeout = 3, message = MGMSG_MOT_REQ_HOMEPARAMS(chan_ident = self._chan_ident))
-        return self._state_home_limit_switch
+        self._wait_for_properties(('_state_home_limit_switch', ), timeout = 3, message = self._msg_req_homeparams)
+        return self._value('home_limit_switch')
     
     @property
     def home_offset_distance(self):
-        self._wait_for_properties(('_state_home_offset_distance', ), timeout = 3, message = MGMSG_MOT_REQ_HOMEPARAMS(chan_ident = self._chan_ident))
-        return self._state_home_offset_distance / self._EncCnt
+        self._wait_for_properties(('_state_home_offset_distance', ), timeout = 3, message = self._msg_req_homeparams)
+        return self._value('home_offset_distance')
     
     def _set_homeparams(self, home_velocity, home_direction, home_limit_switch, home_offset_distance):
         msg = MGMSG_MOT_SET_HOMEPARAMS( 
             chan_ident = self._chan_ident,
-            home_velocity = int(home_velocity *(self._EncCnt * self._T * 65536)),
+            home_velocity = self._profile.velocity_to_apt(home_velocity),
             home_direction = home_direction,
             limit_switch = home_limit_switch,
-            offset_distance = int(home_offset_distance*self._EncCnt)
+            offset_distance = self._profile.position_to_counts(home_offset_distance)
         )
         self._port.send_message(msg)
         #Invalidate current values
@@ -389,50 +453,57 @@ class GenericStage:
     #Conversion factors
     @property
     def _EncCnt(self):
-        return self._conf_steps_per_rev * self._conf_gearbox_ratio / self._conf_pitch
+        return self._profile.position_factor
     
     @property
     def _T(self):
-        return 2048 / 6e6
+        return self._profile.T
     
     @property
     def units(self):
-        return {1: 'mm', 2: '°'}[self._conf_units]
+        return self._profile.units
+    
+    @property
+    def profile(self):
+        """The :class:`~thorpy.stages.database.StageProfile` of this stage, e.g. for converting arrays of positions"""
+        return self._profile
     
     def print_state(self):
         print("Stage: {0}".format(self._name))
-        print("Position: {0:0.03f}{1}".format(self.position, self.units))
+        status = self.status()
+        print("Position: {0:0.03f}{1}".format(status.position, self.units))
         # Velocity information not available with some stages, e.g. LTS300
-        #print("Velocity: {0:0.03f}{1}/s".format(self.velocity, self.units))
+        if status.velocity is not None:
+            print("Velocity: {0:0.03f}{1}/s".format(status.velocity, self.units))
         
         flags = []
-        if self.status_forward_hardware_limit_switch_active:
+        if status.forward_hardware_limit_switch_active:
             flags.append("forward hardware limit switch is active")
-        if self.status_reverse_hardware_limit_switch_active:
+        if status.reverse_hardware_limit_switch_active:
             flags.append("reverse hardware limit switch is active")
-        if self.status_in_motion_forward or self.status_in_motion_reverse or self.status_in_motion_jogging_forward or self.status_in_motion_jogging_reverse or self.status_in_motion_homing:
+        if status.in_motion:
             flags.append('in motion')
-        if self.status_in_motion_forward:
+        if status.in_motion_forward:
             flags.append('moving forward')
-        if self.status_in_motion_reverse:
+        if status.in_motion_reverse:
             flags.append('moving reverse')
-        if self.status_in_motion_jogging_forward:
+        if status.in_motion_jogging_forward:
             flags.append('jogging forward')
-        if self.status_in_motion_jogging_reverse:
+        if status.in_motion_jogging_reverse:
             flags.append('jogging reverse')
-        if self.status_in_motion_homing:
+        if status.in_motion_homing:
             flags.append('homing')
-        if self.status_homed:
+        if status.homed:
             flags.append('homed')
-        if self.status_tracking:
+        if status.tracking:
             flags.append('tracking')
-        if self.status_settled:
+        if status.settled:
             flags.append('settled')
-        if self.status_motion_error:
+        if status.motion_error:
             flags.append('motion error')
-        if self.status_motor_current_limit_reached:
+        if status.motor_current_limit_reached:
             flags.append('motor current limit reached')
-        if self.status_channel_enabled:
+        if status.channel_enabled:
             flags.append('channel enabled')
             
         print("Status: {0}".format(', '.join(flags)))
@@ -447,8 +518,8 @@ class GenericStage:
         
         while not self.status_homed:
             if not self.status_in_motion_forward and not self.status_in_motion_reverse:
-                self._port.send_message(MGMSG_MOT_MOVE_HOME(chan_ident = self._chan_ident))
-            time.sleep(1)
+                self._port.send_bytes(self._msg_move_home.encode())
+            self._clock.sleep(1)
 
         return True
 
@@ -456,20 +527,27 @@ class GenericStage:
         if self.status_homed and not force:
             return True
         
-        self._port.send_message(MGMSG_MOT_MOVE_HOME(chan_ident = self._chan_ident))     
+        self._port.send_bytes(self._msg_move_home.encode())     
         return True
 
-    def _wait_for_properties(self, properties, timeout = None, message = None, message_repeat_timeout = None):
-        start_time = time.time()
-        last_message_time = 0
-        while any(getattr(self, prop) is None for prop in properties):
-            if message is not None:
-                if last_message_time == 0 or (message_repeat_timeout is not None and time.time() - last_message_time > message_repeat_timeout):
-                    self._port.send_message(message)
-                    last_message_time = time.time()
-            time.sleep(0.1)
-            if timeout is not None and time.time() - start_time >= timeout:
+    def _wait_for_properties(self, properties, timeout = None, message = None, message_repeat_timeout = None, max_age = None):
+        """Wait until properties are known, and received at most max_age seconds before the call (if not None)"""
+        start_time = self._clock.time()
+        message_sent = False
+        oldest = None if max_age is None else start_time - max_age
+        while any(getattr(self, prop) is None or (oldest is not None and self._state_timestamps.get(prop, oldest - 1) < oldest)
+                  for prop in properties):
+            remaining = None if timeout is None else timeout - (self._clock.time() - start_time)
+            if remaining is not None and remaining <= 0:
                 return False
+            if message is not None and (not message_sent or message_repeat_timeout is not None):
+                #Returns as soon as the response is handled
+                if message_repeat_timeout is not None and (remaining is None or message_repeat_timeout < remaining):
+                    remaining = message_repeat_timeout
+                self._port.request(message, timeout = remaining, response_classes = self._response_classes.get(message))
+                message_sent = True
+            else:
+                self._clock.sleep(0.1)
         return True
         
     def __repr__(self):
@@ -0,0 +1,136 @@
+import asyncio
+
+from thorpy.message import *
+from . import GenericStage
+
+def _awaitable_property(name):
+    """Awaitable version of the GenericStage property name"""
+    async def get(self):
+        return await self.read(name)
+
+    return property(get, doc = getattr(GenericStage, name).__doc__)
+
+class AsyncStage(GenericStage):
+    """Stage on an :class:`~thorpy.comm.asyncport.AsyncPort`, with awaitable state and parameters.
+
+    Reading a property returns an awaitable, e.g. ``await stage.position``. Parameters are changed with
+    :meth:`set_velocity_parameters` and :meth:`set_home_parameters`, since setters cannot be awaited.
+    """
+    #STATUSUPDATE
+    position = property(_awaitable_property('position').fget,
+                        GenericStage.position.fset)
+    velocity = _awaitable_property('velocity')
+    status_forward_hardware_limit_switch_active = _awaitable_property('status_forward_hardware_limit_switch_active')
+    status_reverse_hardware_limit_switch_active = _awaitable_property('status_reverse_hardware_limit_switch_active')
+    status_in_motion_forward = _awaitable_property('status_in_motion_forward')
+    status_in_motion_reverse = _awaitable_property('status_in_motion_reverse')
+    status_in_motion_jogging_forward = _awaitable_property('status_in_motion_jogging_forward')
+    status_in_motion_jogging_reverse = _awaitable_property('status_in_motion_jogging_reverse')
+    status_in_motion_homing = _awaitable_property('status_in_motion_homing')
+    status_homed = _awaitable_property('status_homed')
+    status_tracking = _awaitable_property('status_tracking')
+    status_settled = _awaitable_property('status_settled')
+    status_motion_error = _awaitable_property('status_motion_error')
+    status_motor_current_limit_reached = _awaitable_property('status_motor_current_limit_reached')
+    status_channel_enabled = _awaitable_property('status_channel_enabled')
+
+    async def status(self, timeout = 3, max_age = None):
+        """See :meth:`GenericStage.status`, raises :class:`asyncio.TimeoutError` if no status is received in time"""
+        if not await self._wait_for_properties_async(('_state_status', ), timeout = timeout, message = self._msg_req_dcstatusupdate,
+                                                     max_age = max_age):
+            raise asyncio.TimeoutError('status')
+        return self._status_snapshot()
+
+    async def read(self, name, max_age = None, timeout = 3):
+        """See :meth:`GenericStage.read`, raises :class:`asyncio.TimeoutError` if the value is not received in time"""
+        state, message = self._property_states[name]
+        if not await self._wait_for_properties_async((state, ), timeout = timeout, message = getattr(self, message), max_age = max_age):
+            raise asyncio.TimeoutError(name)
+        return self._value(name)
+
+    #VELPARAMS
+    min_velocity = _awaitable_property('min_velocity')
+    max_velocity = _awaitable_property('max_velocity')
+    acceleration = _awaitable_property('acceleration')
+
+    #HOMEPARAMS
+    home_velocity = _awaitable_property('home_velocity')
+    home_direction = _awaitable_property('home_direction')
+    home_limit_switch = _awaitable_property('home_limit_switch')
+    home_offset_distance = _awaitable_property('home_offset_distance')
+
+    async def set_velocity_parameters(self, min_velocity = None, max_velocity = None, acceleration = None):
+        """Set the velocity parameters, the ones which are None are kept"""
+        self._set_velparams(float(min_velocity if min_velocity is not None else await self.min_velocity),
+                            float(max_velocity if max_velocity is not None else await self.max_velocity),
+                            float(acceleration if acceleration is not None else await self.acceleration))
+
+    async def set_home_parameters(self, home_velocity = None, home_direction = None, home_limit_switch = None, home_offset_distance = None):
+        """Set the homing parameters, the ones which are None are kept"""
+        self._set_homeparams(float(home_velocity if home_velocity is not None else await self.home_velocity),
+                             home_direction if home_direction is not None else await self.home_direction,
+                             home_limit_switch if home_limit_switch is not None else await self.home_limit_switch,
+                             float(home_offset_distance if home_offset_distance is not None else await self.home_offset_distance))
+
+    async def move_to(self, new_value, timeout = None):
+        """Move to the absolute position new_value and wait until the move is completed.
+
+        :return: True if the move completed, False on timeout
+        """
+        assert type(new_value) in (float, int)
+        response = await self._port.request(self._msg_move_absolute, timeout = timeout,
+                                            response_classes = (MGMSG_MOT_MOVE_COMPLETED, ),
+                                            values = (self._profile.position_to_counts(new_value), ))
+        return response is not None
+
+    async def home(self, force = False):
+        if await self.status_homed and not force:
+            return True
+
+        while not await self.status_homed:
+            if not await self.status_in_motion_forward and not await self.status_in_motion_reverse:
+                self._port.send_bytes(self._msg_move_home.encode())
+            await asyncio.sleep(1)
+
+        return True
+
+    async def home_non_blocking(self, force = True):
+        if await self.status_homed and not force:
+            return True
+
+        self._port.send_bytes(self._msg_move_home.encode())
+        return True
+
+    async def print_state(self):
+        print("Stage: {0}".format(self._name))
+        print("Position: {0:0.03f}{1}".format(await self.position, self.units))
+        print("")
+        print("Velocity parameters: velocity: {0:0.3f}-{1:0.3f}{2}/s, acceleration: {3:0.3f}{2}/s²".format(
+            await self.min_velocity, await self.max_velocity, self.units, await self.acceleration))
+        print("Homing parameters: velocity: {0:0.3f}{1}/s, direction: {2}, limit_switch: {3}, offset_distance: {4:0.3f}{1}".format(
+            await self.home_velocity, self.units, await self.home_direction, await self.home_limit_switch, await self.home_offset_distance))
+
+    def _wait_for_properties(self, *args, **kwargs):
+        #The inherited synchronous methods would block the event loop, and AsyncPort.request must be awaited
+        raise TypeError("{0!r} cannot wait synchronously, use the awaitable methods and properties".format(self))
+
+    async def _wait_for_properties_async(self, properties, timeout = None, message = None, message_repeat_timeout = None, max_age = None):
+        """See :meth:`GenericStage._wait_for_properties`"""
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        message_sent = False
+        #The states are timestamped with the stage clock
+        oldest = None if max_age is None else self._clock.time() - max_age
+        while any(getattr(self, prop) is None or (oldest is not None and self._state_timestamps.get(prop, oldest - 1) < oldest)
+                  for prop in properties):
+            remaining = None if timeout is None else timeout - (loop.time() - start_time)
+            if remaining is not None and remaining <= 0:
+                return False
+            if message is not None and (not message_sent or message_repeat_timeout is not None):
+                if message_repeat_timeout is not None and (remaining is None or message_repeat_timeout < remaining):
+                    remaining = message_repeat_timeout
+                await self._port.request(message, timeout = remaining, response_classes = self._response_classes.get(message))
+                message_sent = True
+            else:
+                await asyncio.sleep(0.1)
+        return True
@@ -0,0 +1,257 @@
+import collections
+import threading
+
+#(attribute, ini key, type), type is 'int', 'float' or 'boolean'
+_fields = [
+    ('stage_id', 'Stage ID', 'int'),
+    ('axis_id', 'Axis ID', 'int'),
+    ('units', 'Units', 'int'),
+    ('pitch', 'Pitch', 'float'),
+    ('dir_sense', 'Dir Sense', 'int'),
+    ('min_pos', 'Min Pos', 'float'),
+    ('max_pos', 'Max Pos', 'float'),
+    ('def_min_vel', 'Def Min Vel', 'float'),
+    ('def_accn', 'Def Accn', 'float'),
+    ('def_max_vel', 'Def Max Vel', 'float'),
+    ('max_accn', 'Max Accn', 'float'),
+    ('max_vel', 'Max Vel', 'float'),
+    ('backlash_dist', 'Backlash Dist', 'float'),
+    ('move_factor', 'Move Factor', 'int'),
+    ('rest_factor', 'Rest Factor', 'int'),
+    ('cw_hard_limit', 'CW Hard Limit', 'int'),
+    ('ccw_hard_limit', 'CCW Hard Limit', 'int'),
+    ('cw_soft_limit', 'CW Soft Limit', 'float'),
+    ('ccw_soft_limit', 'CCW Soft Limit', 'float'),
+    ('soft_limit_mode', 'Soft Limit Mode', 'int'),
+    ('home_dir', 'Home Dir', 'int'),
+    ('home_limit_switch', 'Home Limit Switch', 'int'),
+    ('home_vel', 'Home Vel', 'float'),
+    ('home_zero_offset', 'Home Zero Offset', 'float'),
+    ('jog_mode', 'Jog Mode', 'int'),
+    ('jog_step_size', 'Jog Step Size', 'float'),
+    ('jog_min_vel', 'Jog Min Vel', 'float'),
+    ('jog_accn', 'Jog Accn', 'float'),
+    ('jog_max_vel', 'Jog Max Vel', 'float'),
+    ('jog_stop_mode', 'Jog Stop Mode', 'int'),
+    ('steps_per_rev', 'Steps Per Rev', 'int'),
+    ('gearbox_ratio', 'Gearbox Ratio', 'int'),
+]
+
+#Only present if the flag (first entry) is set, None otherwise
+_optional_fields = [
+    (('dc_servo', 'DC Servo', 'boolean'), [
+        ('dc_prop', 'DC Prop', 'int'),
+        ('dc_int', 'DC Int', 'int'),
+        ('dc_diff', 'DC Diff', 'int'),
+        ('dc_intlim', 'DC IntLim', 'int'),
+    ]),
+    (('fp_controls', 'FP Controls', 'boolean'), [
+        ('pot_zero_wnd', 'Pot Zero Wnd', 'int'),
+        ('pot_vel_1', 'Pot Vel 1', 'float'),
+        ('pot_wnd_1', 'Pot Wnd 1', 'int'),
+        ('pot_vel_2', 'Pot Vel 2', 'float'),
+        ('pot_wnd_2', 'Pot Wnd 2', 'int'),
+        ('pot_vel_3', 'Pot Vel 3', 'float'),
+        ('pot_wnd_3', 'Pot Wnd 3', 'int'),
+        ('pot_vel_4', 'Pot Vel 4', 'float'),
+        ('button_mode', 'Button Mode', 'int'),
+        ('button_pos_1', 'Button Pos 1', 'float'),
+        ('button_pos_2', 'Button Pos 2', 'float'),
+    ]),
+    (('js_params', 'JS Params', 'boolean'), [
+        ('js_gearlow_maxvel', 'JS GearLow MaxVel', 'float'),
+        ('js_gearlow_accn', 'JS GearLow Accn', 'float'),
+        ('js_dir_sense', 'JS Dir Sense', 'float'),
+    ]),
+]
+
+StageRecord = collections.namedtuple('StageRecord',
+    ['name'] + [x[0] for x in _fields] + [y[0] for flag, fields in _optional_fields for y in [flag] + fields] + ['enc_cnt'])
+StageRecord.__doc__ = """Configuration of a stage type, from its section of MG17APTServer.ini.
+
+The fields are the keys of the section in lower case with underscores, e.g. steps_per_rev for 'Steps Per Rev'.
+The fields following the dc_servo, fp_controls and js_params flags are None if the flag is not set.
+enc_cnt is the number of encoder counts per unit, steps_per_rev * gearbox_ratio / pitch."""
+
+_database = None
+_database_lock = threading.Lock()
+
+def _read_section(config, name):
+    section = config[name]
+    getters = {'int': section.getint, 'float': section.getfloat,
+               'boolean': lambda key: section.getboolean(key, fallback = False)}
+    values = {'name': name}
+    for attribute, key, kind in _fields:
+        values[attribute] = getters[kind](key)
+    for (flag, flag_key, flag_kind), fields in _optional_fields:
+        values[flag] = getters[flag_kind](flag_key)
+        for attribute, key, kind in fields:
+            values[attribute] = getters[kind](key) if values[flag] else None
+    values['enc_cnt'] = values['steps_per_rev'] * values['gearbox_ratio'] / values['pitch']
+    return StageRecord(**values)
+
+def _ini_data():
+    import pkgutil
+    return pkgutil.get_data('thorpy.stages', 'MG17APTServer.ini')
+
+def _compiled_path(ini_data):
+    """Path of the compiled database in the user cache directory, for this content of the INI"""
+    import hashlib, os
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'thorpy', 'stages-{0}.json'.format(hashlib.sha1(ini_data).hexdigest()[:16]))
+
+def _compile(ini_data):
+    """Parse the INI, return {section: StageRecord} for all the stage sections"""
+    import configparser
+    config = configparser.ConfigParser()
+    config.read_string(ini_data.decode('ascii'))
+    return dict((name, _read_section(config, name)) for name in config.sections() if config.has_option(name, 'Stage ID'))
+
+def _load_compiled(path):
+    import json
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if data['fields'] != list(StageRecord._fields):
+            return None
+        return dict((record[0], StageRecord(*record)) for record in data['records'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def _save_compiled(path, database):
+    import json, os
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'fields': list(StageRecord._fields), 'records': [list(record) for record in database.values()]}, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass  #Read-only home, the INI is parsed again in the next process
+
+def stage_database():
+    """Return {section name: :class:`StageRecord`} for all the stages of MG17APTServer.ini.
+
+    The database is built once per process, on first use. The parsed records are kept in the user
+    cache directory, keyed by the content of the INI, so that later processes do not parse it again.
+    """
+    global _database
+    if _database is None:
+        with _database_lock:
+            if _database is None:
+                ini_data = _ini_data()
+                path = _compiled_path(ini_data)
+                database = _load_compiled(path)
+                if database is None:
+                    database = _compile(ini_data)
+                    _save_compiled(path, database)
+                _database = database
+    return _database
+
+class StageProfile:
+    """Unit conversions of a stage type, with the scale factors computed once.
+
+    Physical units are mm or degrees (see :attr:`units`), the APT units are those of the messages:
+    encoder counts for positions, and the velocity and acceleration words of VELPARAMS and HOMEPARAMS,
+    scaled by the sampling period :attr:`T` and 65536. The velocity of the status updates is scaled
+    without the 65536 factor, which otherwise gives false results.
+
+    The plural methods (e.g. :meth:`positions_to_counts`) convert whole arrays at once, they need NumPy.
+
+    Instances are immutable and shared by all the stages of a type, get them with :func:`stage_profile`.
+    """
+    __slots__ = ('name', 'units', 'min_pos', 'max_pos', 'position_factor', 'velocity_factor',
+                 'acceleration_factor', 'status_velocity_factor')
+
+    #Sampling period of the controller
+    T = 2048 / 6e6
+
+    def __init__(self, record):
+        for name, value in [('name', record.name), ('units', {1: 'mm', 2: '°'}[record.units]),
+                            ('min_pos', record.min_pos), ('max_pos', record.max_pos),
+                            ('position_factor', record.enc_cnt),
+                            ('velocity_factor', record.enc_cnt * self.T * 65536),
+                            ('acceleration_factor', record.enc_cnt * (self.T ** 2) * 65536),
+                            ('status_velocity_factor', record.enc_cnt * self.T)]:
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{0} is immutable".format(self.__class__.__name__))
+
+    def position_to_counts(self, position, clip = False):
+        """Return the encoder counts of position rounded to the nearest count, clipped to Min Pos/Max Pos if clip"""
+        if clip:
+            position = min(max(position, self.min_pos), self.max_pos)
+        return round(position * self.position_factor)
+
+    def counts_to_position(self, counts):
+        return counts / self.position_factor
+
+    def velocity_to_apt(self, velocity):
+        return int(velocity * self.velocity_factor)
+
+    def apt_to_velocity(self, word):
+        return word / self.velocity_factor
+
+    def acceleration_to_apt(self, acceleration):
+        return int(acceleration * self.acceleration_factor)
+
+    def apt_to_acceleration(self, word):
+        return word / self.acceleration_factor
+
+    def status_velocity(self, word):
+        """Velocity of a DCSTATUSUPDATE message, in units/s"""
+        return word / self.status_velocity_factor
+
+    #Vectorized conversions, for NumPy arrays (or anything numpy.asarray accepts)
+
+    def positions_to_counts(self, positions, clip = True):
+        """Return the encoder counts (int32 array) of positions, as by :meth:`position_to_counts`.
+
+        Unlike :meth:`position_to_counts`, the positions are clipped to Min Pos/Max Pos by default.
+        """
+        import numpy
+        positions = numpy.asarray(positions, dtype = numpy.float64)
+        if clip:
+            positions = numpy.clip(positions, self.min_pos, self.max_pos)
+        return numpy.rint(positions * self.position_factor).astype(numpy.int32)
+
+    def counts_to_positions(self, counts):
+        import numpy
+        return numpy.asarray(counts, dtype = numpy.float64) / self.position_factor
+
+    def velocities_to_apt(self, velocities):
+        """Return the velocity words (uint32 array), truncated as by :meth:`velocity_to_apt`"""
+        import numpy
+        return numpy.trunc(numpy.asarray(velocities, dtype = numpy.float64) * self.velocity_factor).astype(numpy.uint32)
+
+    def apt_to_velocities(self, words):
+        import numpy
+        return numpy.asarray(words, dtype = numpy.float64) / self.velocity_factor
+
+    def accelerations_to_apt(self, accelerations):
+        """Return the acceleration words (uint32 array), truncated as by :meth:`acceleration_to_apt`"""
+        import numpy
+        return numpy.trunc(numpy.asarray(accelerations, dtype = numpy.float64) * self.acceleration_factor).astype(numpy.uint32)
+
+    def apt_to_accelerations(self, words):
+        import numpy
+        return numpy.asarray(words, dtype = numpy.float64) / self.acceleration_factor
+
+    def status_velocities(self, words):
+        """Velocities of DCSTATUSUPDATE messages, in units/s, see :meth:`status_velocity`"""
+        import numpy
+        return numpy.asarray(words, dtype = numpy.float64) / self.status_velocity_factor
+
+    def __repr__(self):
+        return '<{0} {1}: {2} counts/{3}>'.format(self.__class__.__name__, self.name, self.position_factor, self.units)
+
+_profiles = {}
+
+def stage_profile(name):
+    """Return the :class:`StageProfile` of the stage type of section name of MG17APTServer.ini"""
+    profile = _profiles.get(name, None)
+    if profile is None:
+        #Concurrent callers may build it twice, they get equal profiles
+        profile = _profiles.setdefault(name, StageProfile(stage_database()[name]))
+    return profile